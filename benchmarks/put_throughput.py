@@ -0,0 +1,63 @@
+"""
+This file is part of Candela.
+
+Candela is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Candela is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Candela.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Measure Shell.put() throughput as the scrollback capacity grows
+#
+# The backbuffer is filled to capacity first, so every timed put() also
+# evicts the oldest line. The shell draws to a VirtualRenderer so that only
+# candela's own work is measured.
+#
+#     python benchmarks/put_throughput.py -n 20000
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from candela.shell import Shell, VirtualRenderer
+
+
+def measure(capacity, puts, height, width):
+    """
+    Return the number of put() calls per second on a full backbuffer
+    """
+    shell = Shell(scrollback=capacity, renderer=VirtualRenderer(height, width))
+    for i in range(capacity):
+        shell.backbuffer.append(("scrollback line %d" % i, False))
+    start = timeit.default_timer()
+    for i in range(puts):
+        shell.put("output line %d" % i)
+    return puts / (timeit.default_timer() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure put() throughput by scrollback capacity")
+    parser.add_argument('-n', '--puts', type=int, default=20000)
+    parser.add_argument('--rows', type=int, default=50)
+    parser.add_argument('--cols', type=int, default=160)
+    opts = parser.parse_args()
+
+    print("%10s %12s" % ("capacity", "puts/sec"))
+    for capacity in (200, 1000, 10000, 100000):
+        rate = measure(capacity, opts.puts, opts.rows, opts.cols)
+        print("%10d %12.0f" % (capacity, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+This file is part of Candela.
+
+Candela is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Candela is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Candela.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Stress test for output from many threads at once
+#
+# Worker threads call put(), put_many() and sticker() as fast as they can
+# while the main thread plays the UI thread, draining the output queue and
+# redrawing a virtual screen. Afterwards the backbuffer must hold every line
+# exactly once, each thread's lines must be in the order it printed them,
+# and the screen must show the newest lines. Exits non-zero on any failure.
+#
+#     python benchmarks/stress_put.py --threads 32 --lines 5000
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from candela.shell import Shell, VirtualRenderer
+
+
+def worker(shell, n, lines, start):
+    start.wait()
+    sticker = None
+    for i in range(lines):
+        text = "t%d l%d" % (n, i)
+        if i % 100 == 99:
+            shell.put_many([text])
+            new_sticker = "thread %d at %d" % (n, i)
+            shell.sticker(sticker or new_sticker, new_sticker)
+            sticker = new_sticker
+        else:
+            shell.put(text)
+
+
+def check(shell, threads, lines):
+    """
+    Return a list of problems found in the shell's state
+    """
+    problems = []
+    seen = {}
+    for text, command in shell.backbuffer:
+        n, i = text.split()
+        n, i = int(n[1:]), int(i[1:])
+        if seen.get(n, -1) >= i:
+            problems.append("thread %d printed line %d out of order" % (n, i))
+        seen[n] = i
+    if len(shell.backbuffer) != threads * lines:
+        problems.append("expected %d lines, found %d" % (threads * lines, len(shell.backbuffer)))
+    for n in range(threads):
+        if seen.get(n) != lines - 1:
+            problems.append("thread %d's last line is missing" % n)
+    stickers = [text for text, pos in shell.stickers]
+    if lines >= 100:
+        if len(stickers) != threads:
+            problems.append("expected %d stickers, found %d" % (threads, len(stickers)))
+        last = lines // 100 * 100 - 1
+        for n in range(threads):
+            if "thread %d at %d" % (n, last) not in stickers:
+                problems.append("thread %d's sticker is stale" % n)
+    # the bottom rows of the screen, above the input line, show the newest
+    # output. stickers may cover their right side
+    shown = [row.rstrip() for row in shell.renderer.display()[:-1]]
+    newest = [text for text, command in list(shell.backbuffer)[-3:]]
+    for row, text in zip(shown[-3:], newest):
+        if not row.startswith(text):
+            problems.append("screen shows %r where %r belongs" % (row, text))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hammer put() from many threads")
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--lines', type=int, default=2000)
+    opts = parser.parse_args()
+
+    total = opts.threads * opts.lines
+    shell = Shell(scrollback=total, renderer=VirtualRenderer(50, 160))
+    start = threading.Event()
+    workers = [threading.Thread(target=worker, args=(shell, n, opts.lines, start))
+               for n in range(opts.threads)]
+    for thread in workers:
+        thread.start()
+
+    began = time.time()
+    start.set()
+    drains = 0
+    while any(thread.is_alive() for thread in workers) or shell._ui_queue:
+        shell._drain_ui_queue()
+        drains += 1
+        time.sleep(0.001)
+    elapsed = time.time() - began
+
+    problems = check(shell, opts.threads, opts.lines)
+    print("%d lines from %d threads in %.2fs, %d drains, %d redraws" % (
+        total, opts.threads, elapsed, drains, shell.frames_rendered))
+    for problem in problems[:20]:
+        print("FAIL: %s" % problem)
+    if problems:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,499 @@
+"""
+This file is part of Candela.
+
+Candela is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Candela is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Candela.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Benchmarks for the hot paths of a Candela shell
+#
+# Every case drives a Shell that draws to a VirtualRenderer, so no terminal
+# is needed. Results are written as JSON with ops/sec and latency
+# percentiles for each case and parameter set. Saving the output of two
+# commits and passing one to --compare prints the relative change.
+#
+#     python benchmarks/suite.py --output before.json
+#     python benchmarks/suite.py --compare before.json
+#     python benchmarks/suite.py --quick --filter tabcomplete
+from __future__ import print_function
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from candela.shell import Shell, VirtualRenderer
+from candela.menu import Menu
+from candela.command import Command
+from candela.history import History, HistorySearch
+from candela.completion import FuzzyMatcher
+
+timer = timeit.default_timer
+
+# registered benchmarks as (name, {param: [values]}, setup function)
+CASES = []
+
+MENU_SIZES = [10, 100, 1000, 10000]
+SCROLLBACK_SIZES = [200, 10000, 100000]
+
+
+def case(name, **grid):
+    """
+    Register a benchmark
+
+    The decorated setup function is called once for each combination of
+    the parameter values in grid, and returns the operation to time. If
+    the operation returns Samples, those are used as the latencies instead
+    of the duration of the call.
+    """
+    def register(setup):
+        CASES.append((name, grid, setup))
+        return setup
+    return register
+
+
+class Samples(list):
+    """
+    Latencies in seconds measured by an operation itself
+    """
+
+
+class TimedRenderer(VirtualRenderer):
+    """
+    A virtual screen that records when each key is read, so that the time
+    spent handling every keystroke can be measured
+    """
+    def __init__(self, *args, **kwargs):
+        VirtualRenderer.__init__(self, *args, **kwargs)
+        self.stamps = []
+
+    def getch(self):
+        self.stamps.append(timer())
+        return VirtualRenderer.getch(self)
+
+
+def build_shell(commands=10, scrollback=200, height=50, width=160):
+    """
+    Return a headless shell with one menu of generated commands and a full
+    backbuffer
+    """
+    shell = Shell(scrollback=scrollback, renderer=TimedRenderer(height, width))
+    shell.header = "benchmark\n---------"
+    menu = Menu('main')
+    menu.title = "Main menu"
+    menu.commands = [Command('command_%05d arg <-f flag> [-g other]' % i,
+                             'Generated command %d' % i)
+                     for i in range(commands)]
+    shell.menus = [menu]
+    shell.menu = 'main'
+    for i in range(scrollback):
+        shell.backbuffer.append(("scrollback line %d" % i, False))
+    return shell
+
+
+@case("put_wrap", scrollback=SCROLLBACK_SIZES)
+def bench_put_wrap(scrollback):
+    shell = build_shell(scrollback=scrollback)
+    line = "wrapped output " * 30
+    return lambda: shell.put(line)
+
+
+@case("add_log_line", width=[80, 250], distinct=[100, 1000000])
+def bench_add_log_line(width, distinct):
+    # the layout work of printing one line of wide log output, without the
+    # redraw. with few distinct lines, most are laid out from the wrap cache
+    shell = build_shell(width=width)
+    words = "GET /assets/bundle request served from cache in ms status ok".split()
+    lines = []
+    for i in range(min(distinct, 1000)):
+        length = 40 + (i * 37) % 260
+        line = "%06d " % i
+        while len(line) < length:
+            line += words[len(line) % len(words)] + " "
+        lines.append(line)
+    counter = itertools.count()
+    def op():
+        i = next(counter)
+        line = lines[i % len(lines)]
+        if distinct > len(lines):
+            line = "%d %s" % (i, line)
+        shell._add_output(line)
+    return op
+
+
+@case("put_burst", max_fps=[0, 30])
+def bench_put_burst(max_fps):
+    # 1000 puts in a row, as a busy command makes them. with max_fps set,
+    # they collapse into a few frames
+    shell = build_shell()
+    shell.max_fps = max_fps
+    def op():
+        for i in range(1000):
+            shell.put("burst line %d" % i)
+    return op
+
+
+@case("input_keystroke", commands=[10, 10000])
+def bench_input_keystroke(commands):
+    shell = build_shell(commands=commands)
+    renderer = shell.renderer
+
+    def op():
+        renderer.stamps = []
+        renderer.feed("command_00001 arg -f x\n")
+        shell._input(shell.prompt)
+        renderer.stamps.append(timer())
+        return Samples(b - a for a, b in zip(renderer.stamps, renderer.stamps[1:]))
+    return op
+
+
+@case("shell_tabcomplete", commands=MENU_SIZES)
+def bench_shell_tabcomplete(commands):
+    shell = build_shell(commands=commands)
+    return lambda: shell._tabcomplete("command_0000")
+
+
+@case("shell_tabcomplete_linear", commands=MENU_SIZES)
+def bench_shell_tabcomplete_linear(commands):
+    # the scan over every name and alias that Menu.complete() replaced,
+    # kept as a reference point
+    shell = build_shell(commands=commands)
+    def op(buff="command_0000"):
+        output = []
+        for command in shell.get_menu().commands:
+            if command.name.startswith(buff):
+                output.append(command.name)
+            for alias in command.aliases:
+                if alias.startswith(buff):
+                    output.append(alias)
+        return output
+    return op
+
+
+@case("command_tabcomplete", candidates=[100, 10000])
+def bench_command_tabcomplete(candidates):
+    command = Command('command arg <-f flag>', 'Complete arguments')
+    choices = ["candidate_%06d" % i for i in range(candidates)]
+    command.tabcomplete_hooks['arg'] = lambda frag: choices
+    return lambda: command._tabcomplete("command candidate_00")
+
+
+def asset_names(count):
+    """
+    Return count generated asset paths, for fuzzy completion
+    """
+    words = ["hero", "knight", "castle", "forest", "stone", "water", "dragon",
+             "sword", "shield", "armor", "village", "tree"]
+    return ["%s/%s_%s_v%02d.png" % (["props", "env", "fx"][i % 3],
+                                    words[i % len(words)],
+                                    words[(i // len(words)) % len(words)], i % 100)
+            for i in range(count)]
+
+
+@case("fuzzy_prepare", candidates=[1000, 100000])
+def bench_fuzzy_prepare(candidates):
+    # the first Tab press on a new list of candidates
+    choices = asset_names(candidates)
+    return lambda: FuzzyMatcher().match(choices, "")
+
+
+@case("fuzzy_complete", candidates=[1000, 100000])
+def bench_fuzzy_complete(candidates):
+    # Tab pressed after each keystroke of a mistyped asset name, timed per
+    # keystroke. the candidates were matched against once before, as they
+    # would be by the first Tab press
+    choices = asset_names(candidates)
+    matcher = FuzzyMatcher()
+    matcher.match(choices, "")
+    def op():
+        samples = Samples()
+        for end in range(1, len("knghtdrgn_v4") + 1):
+            start = timer()
+            matcher.match(choices, "knghtdrgn_v4"[:end])
+            samples.append(timer() - start)
+        return samples
+    return op
+
+
+@case("get_command", commands=MENU_SIZES)
+def bench_get_command(commands):
+    shell = build_shell(commands=commands)
+    buff = "command_%05d arg -f x" % (commands - 1)
+    return lambda: shell._get_command(buff)
+
+
+@case("menu_append", commands=MENU_SIZES)
+def bench_menu_append(commands):
+    # building a menu one command at a time, then aliasing every command
+    definitions = ['command_%05d arg <-f flag> [-g other]' % i for i in range(commands)]
+    def op():
+        menu = Menu('main')
+        for definition in definitions:
+            menu.commands.append(Command(definition, 'Generated command'))
+        for command in menu.commands:
+            command.alias(command.name.replace('command', 'alias'))
+    return op
+
+
+@case("menu_append_fuzzy", commands=MENU_SIZES)
+def bench_menu_append_fuzzy(commands):
+    # Tab pressed with a fuzzy matcher right after each command is added,
+    # which must see the new command rather than the names prepared before
+    menu = build_shell(commands=commands).get_menu()
+    matcher = FuzzyMatcher()
+    menu.complete("cmd", matcher=matcher)
+    added = itertools.count()
+    def op():
+        name = "added_%06d" % next(added)
+        menu.commands.append(Command(name, 'Added command'))
+        return menu.complete(name.replace("_", ""), matcher=matcher)
+    assert op() == ["added_000000"], "fuzzy completion missed a new command"
+    return op
+
+
+@case("parse_command")
+def bench_parse_command():
+    command = Command('command arg1 arg2 <-f flag> [-g other]', 'Parse input')
+    tokens = "command one two -f three -g four".split()
+    return lambda: command.parse_command(tokens)
+
+
+@case("parse_definition")
+def bench_parse_definition():
+    command = Command('command arg1 arg2 <-f flag> [-g other]', 'Parse definitions')
+    tokens = command.definition.split()
+    return lambda: command.parse_definition(tokens)
+
+
+@case("validate")
+def bench_validate():
+    command = Command('command arg1 arg2 <-f flag> [-g other]', 'Validate input')
+    args, kwargs = command.parse_command("command one two -f three".split())
+    return lambda: command.validate(*args, **kwargs)
+
+
+@case("parse_and_validate", commands=[1000])
+def bench_parse_and_validate(commands):
+    # the per-line work of a script, amortized over many lines so that
+    # timer overhead doesn't dominate
+    command = Command('command arg1 arg2 <-f flag> [-g other]', 'Validate input')
+    lines = [("command one%d two -f three -g four" % i).split() for i in range(commands)]
+    def op():
+        for tokens in lines:
+            args, kwargs = command.parse_command(tokens)
+            command.validate(*args, **kwargs)
+    return op
+
+
+@case("update_screen", scrollback=SCROLLBACK_SIZES, commands=[10, 1000])
+def bench_update_screen(scrollback, commands):
+    shell = build_shell(commands=commands, scrollback=scrollback)
+    return shell._update_screen
+
+
+@case("scroll_page", scrollback=SCROLLBACK_SIZES)
+def bench_scroll_page(scrollback):
+    # paging down through the whole backbuffer from the top, then back to
+    # the top once the newest output is reached. some lines are nothing
+    # but whitespace wider than the window, which wrap to a single empty row
+    shell = build_shell(scrollback=scrollback)
+    for i in range(0, scrollback, 10):
+        shell.backbuffer[i] = (" " * 200, False)
+    def op():
+        if shell._scroll_pos is None:
+            shell.scroll_to_top()
+        else:
+            shell.scroll(3 - shell.height)
+    return op
+
+
+@case("sticker_update", stickers=[1, 100])
+def bench_sticker_update(stickers):
+    # a live status counter changing on a full screen
+    shell = build_shell()
+    for i in range(stickers - 1):
+        shell.sticker("status %d" % i)
+    counter = itertools.count()
+    return lambda: shell.sticker("%d files copied" % next(counter), id="counter")
+
+
+@case("stream_output", mode=["put", "yield"])
+def bench_stream_output(mode):
+    # a command printing 1000 lines, either by calling put() for each one or
+    # by yielding them for the shell to render progressively
+    shell = build_shell()
+    menu = shell.get_menu()
+    command = Command('stream', 'Print many lines')
+    def _put(*args, **kwargs):
+        for i in range(1000):
+            shell.put("output line %d" % i)
+    def _yield(*args, **kwargs):
+        for i in range(1000):
+            yield "output line %d" % i
+    command.run = _put if mode == "put" else _yield
+    menu.commands.append(command)
+    return lambda: shell._dispatch("stream")
+
+
+@case("history_search", commands=[10000, 100000, 300000])
+def bench_history_search(commands):
+    # typing a Ctrl-R query one character at a time, over a history where
+    # most commands are distinct. the index is built before timing starts
+    history = History()
+    verbs = ["git commit -m", "git push origin", "make test", "ssh deploy@host",
+             "grep -rn", "vim src/module", "python manage.py", "docker run image"]
+    for i in range(commands):
+        history.append("%s %d" % (verbs[i % len(verbs)], (i * 7919) % commands))
+    history.reset()
+    history.search("")
+    def op():
+        search = HistorySearch(history)
+        for char in "push origin 4":
+            search.add(char)
+    return op
+
+
+@case("script_interactive", lines=[1000, 10000])
+def bench_script_interactive(lines):
+    # a script run by main_loop(), redrawing the screen after every line
+    shell = build_shell()
+    script = b"command_00001 arg -f x\n" * lines
+    def op():
+        shell.runscript(io.BytesIO(script))
+        shell.main_loop()
+    return op
+
+
+@case("script_batch", lines=[1000, 10000])
+def bench_script_batch(lines):
+    shell = build_shell()
+    script = b"command_00001 arg -f x\n" * lines
+    sink = open(os.devnull, 'w')
+    return lambda: shell.run_batch(io.BytesIO(script), output=sink, echo=True)
+
+
+def percentile(samples, fraction):
+    """
+    Return the value below which the given fraction of sorted samples fall
+    """
+    index = min(int(round(fraction * (len(samples) - 1))), len(samples) - 1)
+    return samples[index]
+
+
+def run_case(op, iterations, warmup):
+    """
+    Time op and return a result dictionary with throughput and percentiles
+    in microseconds
+    """
+    for i in range(warmup):
+        op()
+    samples = []
+    start = timer()
+    for i in range(iterations):
+        began = timer()
+        result = op()
+        if isinstance(result, Samples):
+            samples.extend(result)
+        else:
+            samples.append(timer() - began)
+    elapsed = timer() - start
+    samples.sort()
+    return {
+        "ops": len(samples),
+        "ops_per_sec": len(samples) / sum(samples) if sum(samples) else None,
+        "wall_seconds": elapsed,
+        "mean_us": 1e6 * sum(samples) / len(samples),
+        "p50_us": 1e6 * percentile(samples, 0.50),
+        "p90_us": 1e6 * percentile(samples, 0.90),
+        "p99_us": 1e6 * percentile(samples, 0.99),
+        "max_us": 1e6 * samples[-1],
+    }
+
+
+def result_key(result):
+    params = ",".join("%s=%s" % kv for kv in sorted(result["params"].items()))
+    return "%s[%s]" % (result["name"], params)
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                      cwd=ROOT, stderr=open(os.devnull, 'w'))
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Candela benchmark suite")
+    parser.add_argument('--quick', action='store_true',
+                        help="fewer iterations and only the smallest sizes")
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--filter', default='',
+                        help="only run cases whose name contains this string")
+    parser.add_argument('--output', help="write the JSON report to this file")
+    parser.add_argument('--compare', help="a previous JSON report to compare against")
+    opts = parser.parse_args()
+
+    iterations = 100 if opts.quick else opts.iterations
+    results = []
+    for name, grid, setup in CASES:
+        if opts.filter not in name:
+            continue
+        keys = sorted(grid)
+        values = [grid[k][:2] if opts.quick else grid[k] for k in keys]
+        for combo in itertools.product(*values):
+            params = dict(zip(keys, combo))
+            op = setup(**params)
+            result = {"name": name, "params": params}
+            result.update(run_case(op, iterations, max(iterations // 10, 1)))
+            results.append(result)
+            print("%-50s %12.0f ops/s  p50 %9.1fus  p99 %9.1fus" % (
+                result_key(result), result["ops_per_sec"] or 0,
+                result["p50_us"], result["p99_us"]), file=sys.stderr)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "iterations": iterations,
+        "results": results,
+    }
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            before = dict((result_key(r), r) for r in json.load(f)["results"])
+        for result in results:
+            old = before.get(result_key(result))
+            if old and old["ops_per_sec"] and result["ops_per_sec"]:
+                print("%-50s %7.2fx" % (result_key(result),
+                      result["ops_per_sec"] / old["ops_per_sec"]), file=sys.stderr)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+This file is part of Candela.
+
+Candela is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Candela is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Candela.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Measure how many bytes a Shell writes to its terminal for each call to put()
+#
+# The shell runs in a child process attached to a pseudo-terminal, and the
+# parent counts every byte curses emits. A run with no puts is subtracted to
+# remove the cost of curses startup and shutdown.
+#
+#     python benchmarks/tty_bytes.py -n 500
+from __future__ import print_function
+
+import argparse
+import errno
+import fcntl
+import os
+import pty
+import struct
+import sys
+import termios
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from candela.shell import Shell
+from candela.menu import Menu
+from candela.command import Command
+
+
+def _run_child(puts, rows, cols):
+    fcntl.ioctl(sys.stdout.fileno(), termios.TIOCSWINSZ,
+                struct.pack('HHHH', rows, cols, 0, 0))
+    os.environ['TERM'] = 'xterm'
+
+    shell = Shell()
+    shell.header = "benchmark\n---------"
+    menu = Menu('main')
+    menu.title = "Main menu"
+    menu.commands = [Command('command_%d arg <-f flag>' % i, 'Command %d' % i)
+                     for i in range(10)]
+    shell.menus = [menu]
+    shell.menu = 'main'
+    shell.sticker("sticker")
+
+    for i in range(puts):
+        shell.put("output line %d of the benchmark run" % i)
+    shell.end()
+    os._exit(0)
+
+
+def count_bytes(puts, rows, cols):
+    """
+    Return the number of bytes written to the tty by a shell doing `puts` puts
+    """
+    pid, fd = pty.fork()
+    if pid == 0:
+        _run_child(puts, rows, cols)
+    total = 0
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except OSError as e:
+            if e.errno != errno.EIO:
+                raise
+            break
+        if not data:
+            break
+        total += len(data)
+    os.waitpid(pid, 0)
+    os.close(fd)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count tty bytes written per Shell.put()")
+    parser.add_argument('-n', '--puts', type=int, default=500)
+    parser.add_argument('--rows', type=int, default=50)
+    parser.add_argument('--cols', type=int, default=160)
+    opts = parser.parse_args()
+
+    base = count_bytes(0, opts.rows, opts.cols)
+    loaded = count_bytes(opts.puts, opts.rows, opts.cols)
+    print("terminal:      %dx%d" % (opts.cols, opts.rows))
+    print("puts:          %d" % opts.puts)
+    print("bytes total:   %d" % (loaded - base))
+    print("bytes per put: %.1f" % (float(loaded - base) / max(opts.puts, 1)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""
+This file is part of Candela.
+
+Candela is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Candela is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Candela.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# The asyncio main loop behind Shell.main_loop_async(). Python 3.7+ only,
+# so the shell module imports this lazily.
+import asyncio
+import curses
+import inspect
+import signal
+import threading
+
+from candela import constants
+
+
+class _KeyReader(object):
+    """
+    Reads keys from the shell's renderer without blocking the event loop.
+
+    When the renderer reads from a file descriptor, the event loop watches it
+    and every available key is queued as soon as it arrives. Renderers
+    without one, like the VirtualRenderer, are read directly, yielding to
+    other tasks before each key.
+
+    A resized terminal sends SIGWINCH rather than making the file descriptor
+    readable, so the event loop watches for it too and queues
+    curses.KEY_RESIZE when it arrives.
+    """
+    def __init__(self, renderer, loop):
+        self.renderer = renderer
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        # set whenever new keys are queued
+        self.arrived = asyncio.Event()
+        self.fd = renderer.fileno()
+        self.winch = False
+        if self.fd is not None:
+            renderer.nodelay(True)
+            loop.add_reader(self.fd, self._drain)
+            self._watch_resize()
+
+    def _watch_resize(self):
+        if not hasattr(signal, 'SIGWINCH'):
+            return
+        try:
+            self.loop.add_signal_handler(signal.SIGWINCH, self._resized)
+        except (ValueError, RuntimeError, NotImplementedError):
+            # not the main thread, or a loop without signal support. the
+            # resize is then seen with the next key
+            return
+        self.winch = True
+
+    def _drain(self):
+        key = self.renderer.getch()
+        while key != -1:
+            self.queue.put_nowait(key)
+            self.arrived.set()
+            key = self.renderer.getch()
+
+    def _resized(self):
+        # the loop's handler replaces the one curses installed, so curses
+        # has to be told the new size
+        update_size = getattr(self.renderer, 'update_size', None)
+        if update_size is not None:
+            update_size()
+        self.queue.put_nowait(curses.KEY_RESIZE)
+        self.arrived.set()
+        self._drain()
+
+    async def get(self):
+        """
+        Return the next key. Raises EOFError if the renderer has run out
+        """
+        if self.fd is None:
+            await asyncio.sleep(0)
+            return self.renderer.getch()
+        return await self.queue.get()
+
+    def close(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.renderer.nodelay(False)
+        if self.winch:
+            # this leaves SIGWINCH at its default rather than giving it back
+            # to curses, whose handler python has no way to restore
+            self.loop.remove_signal_handler(signal.SIGWINCH)
+            self.winch = False
+
+
+async def _resolve(value):
+    """
+    Await value if a coroutine callback returned it, otherwise return it as is
+    """
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+async def _dispatch(shell, choice):
+    """
+    The coroutine version of Shell._dispatch(), awaiting run and validate
+    functions defined with async def
+    """
+    parsed = shell._parse_choice(choice)
+    if not parsed:
+        return constants.CHOICE_INVALID
+    command, args, kwargs = parsed
+    ret_choice = constants.CHOICE_INVALID
+    try:
+        success, message = await _resolve(command.validate(*args, **kwargs))
+        if not success:
+            shell.put(message)
+        else:
+            result = await _resolve(command.run(*args, **kwargs))
+            if hasattr(result, '__anext__') or shell._is_stream(result):
+                result = await _stream(shell, result)
+            ret_choice = result
+            shell._handle_choice(ret_choice)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        shell.put(e)
+    return ret_choice
+
+
+async def _stream(shell, output):
+    """
+    The coroutine version of Shell._stream(), which also accepts async
+    generators. Other tasks get to run, and keys get read, every time the
+    screen is redrawn.
+    """
+    loop = asyncio.get_running_loop()
+    interrupts = shell._interrupts
+    interval = 1.0 / shell.stream_refresh_rate
+    last = loop.time()
+    ret_choice = constants.CHOICE_VALID
+    try:
+        while True:
+            try:
+                if hasattr(output, '__anext__'):
+                    chunk = await output.__anext__()
+                else:
+                    chunk = next(output)
+            except (StopIteration, StopAsyncIteration) as e:
+                if getattr(e, 'value', None) is not None:
+                    ret_choice = e.value
+                break
+            shell._add_output(chunk)
+            now = loop.time()
+            if now - last < interval:
+                continue
+            last = now
+            shell._update_screen()
+            await asyncio.sleep(0)
+            if shell._interrupts != interrupts:
+                if hasattr(output, 'aclose'):
+                    await output.aclose()
+                elif hasattr(output, 'close'):
+                    output.close()
+                shell._add_output("Interrupted")
+                break
+    finally:
+        shell._update_screen()
+    return ret_choice
+
+
+async def _tabcomplete(shell, keys):
+    """
+    The coroutine version of Shell._tabcomplete() for the current input line.
+
+    Completion hooks defined with async def are awaited for at most the
+    command's tabcomplete_timeouts entry for the argument, and are cancelled
+    if the user presses another key first. Other hooks are called as usual.
+    """
+    buff = shell._buff
+    command = None
+    if len(buff.split()) > 1 or ' ' in buff:
+        command = shell._get_command(buff)
+    if command is None:
+        return shell._tabcomplete(buff)
+    arg_name = command._completion_target(buff)
+    hook = command.tabcomplete_hooks.get(arg_name)
+    if not asyncio.iscoroutinefunction(hook):
+        return shell._tabcomplete(buff)
+
+    frag = buff.split()[-1]
+    narrow = not buff.endswith(' ')
+    matcher = shell.completion_matcher
+    # a fuzzy matcher ranks every candidate the hook knows of
+    hook_frag = "" if matcher is not None and narrow else frag
+    cache = shell.completion_cache
+    results = command._cached_completions(arg_name, hook_frag, cache, narrow and not matcher)
+    if results is None:
+        results = await _call_hook(hook, hook_frag, command.tabcomplete_timeouts.get(arg_name), keys)
+        if results is None:
+            return []
+        if cache is not None:
+            results = cache.put((command, arg_name, hook_frag), results)
+    if matcher is not None and narrow:
+        return matcher.match(results, frag)
+    if narrow:
+        results = [a for a in results if a.startswith(frag)]
+    return results
+
+
+async def _call_hook(hook, frag, timeout, keys):
+    """
+    Await hook(frag), returning None if it timed out or a newer key arrived
+    """
+    call = asyncio.ensure_future(hook(frag))
+    waiters = [call]
+    keys.arrived.clear()
+    if keys.fd is not None:
+        waiters.append(asyncio.ensure_future(keys.arrived.wait()))
+    try:
+        done, pending = await asyncio.wait(waiters, timeout=timeout,
+                                           return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.cancel()
+    if call not in done:
+        return None
+    return call.result()
+
+
+async def _next_key(keys, quit):
+    """
+    Return the next key, or None if a command asked the shell to quit first
+    """
+    if quit.done():
+        return None
+    getter = asyncio.ensure_future(keys.get())
+    done, pending = await asyncio.wait([getter, quit],
+                                       return_when=asyncio.FIRST_COMPLETED)
+    if getter not in done:
+        getter.cancel()
+        return None
+    return getter.result()
+
+
+async def _input(shell, keys, quit):
+    """
+    The coroutine version of Shell._input(). Returns the line the user
+    entered, or None if a command asked the shell to quit first
+    """
+    shell._begin_input(shell.prompt)
+    while True:
+        key = await _next_key(keys, quit)
+        if key is None:
+            return None
+        choices = None
+        if key == 9:  # tab
+            choices = await _tabcomplete(shell, keys)
+        if shell._handle_key(key, choices=choices):
+            return shell._finish_input()
+
+
+async def main_loop(shell):
+    """
+    Run the shell's main IO loop until a command returns
+    constants.CHOICE_QUIT or the renderer runs out of keys.
+
+    Every command entered by the user runs in its own task, so the prompt
+    comes back while it is awaiting. Commands from a script run one at a
+    time, in order. When the shell quits, commands still running are
+    cancelled; when the keys run out, they are waited for.
+
+    Args:
+    shell   - The Shell to run
+
+    Return:
+    The shell
+    """
+    loop = asyncio.get_running_loop()
+    keys = _KeyReader(shell.renderer, loop)
+    quit = loop.create_future()
+    tasks = set()
+    # jobs finishing on other threads hand their callbacks to the event loop
+    shell._ui_thread = threading.current_thread()
+    shell._ui_wakeup = lambda: loop.call_soon_threadsafe(shell._drain_ui_queue)
+    shell._drain_ui_queue()
+    # frames held back by max_fps are drawn by a timer
+    timer = []
+    def _render_later(delay):
+        if not timer:
+            timer.append(loop.call_later(delay, _render))
+    def _render():
+        del timer[:]
+        wait = shell._render_if_due()
+        if wait is not None:
+            _render_later(wait)
+    shell._render_wakeup = _render_later
+
+    def _finished(task):
+        tasks.discard(task)
+        if task.cancelled() or task.exception() is not None:
+            return
+        if task.result() == constants.CHOICE_QUIT and not quit.done():
+            quit.set_result(None)
+
+    try:
+        while not quit.done():
+            choice = shell._script_in()
+            if choice:
+                shell.put("%s%s" % (shell.prompt, choice))
+                if await _dispatch(shell, choice) == constants.CHOICE_QUIT:
+                    break
+                continue
+            try:
+                choice = await _input(shell, keys, quit)
+            except EOFError:
+                if tasks:
+                    await asyncio.wait(list(tasks))
+                break
+            if choice is None:
+                break
+            task = asyncio.ensure_future(_dispatch(shell, choice))
+            tasks.add(task)
+            task.add_done_callback(_finished)
+    finally:
+        keys.close()
+        shell._ui_wakeup = None
+        shell._render_wakeup = None
+        for handle in timer:
+            handle.cancel()
+        shell._flush_frame()
+        for task in list(tasks):
+            task.cancel()
+    return shell
@@ -14,7 +14,9 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with Candela.  If not, see <http://www.gnu.org/licenses/>.
 """
-import constants
+import weakref
+
+from candela import constants
 
 
 class Command(object):
@@ -51,27 +53,29 @@ class Command(object):
         """
         self.name = definition.split()[0]
         self.aliases = []
+        # the menus containing this command, whose indices must be
+        # updated when it gains an alias
+        self._menus = weakref.WeakSet()
 
         self.definition = definition
         self.description = description
 
+        # the positional argument names and the flag: (argument name, required)
+        # pairs of the definition. they are compiled into spec for
+        # validation here, so they must not be changed afterwards
         self.args,self.kwargs = self.parse_definition(definition.split())
+        self.spec = ArgSpec(self.args, self.kwargs)
 
         def runner(*args, **kwargs):
             return constants.CHOICE_VALID
         self.run = runner
 
         def validator(*args, **kwargs):
-            required_params = list(self.args)
-            for kw in self.kwargs.keys():
-                name,reqd = self.kwargs[kw]
-                if reqd:
-                    required_params.append(kw)
-            if len(args) + len(kwargs) < len(required_params):
+            spec = self.spec
+            if len(args) + len(kwargs) < spec.min_count:
                 return (False, "Usage: %s" % self.definition)
-            for kw in self.kwargs.keys():
-                name,reqd = self.kwargs[kw]
-                if reqd and kw not in kwargs.keys():
+            for kw in spec.required:
+                if kw not in kwargs:
                     return (False, "Usage: %s" % (self.definition))
             return (True, "")
         self.validate = validator
@@ -81,6 +85,10 @@ class Command(object):
         # keys are the argument names used in the definition, values are callbacks
         # returning lists of completions
         self.tabcomplete_hooks = {}
+        # hooks listed here run off the UI thread, and the shell waits for them
+        # for at most this many seconds
+        # keys are argument names, values are timeouts
+        self.tabcomplete_timeouts = {}
 
     def parse_command(self, tokens):
         """
@@ -102,6 +110,9 @@ class Command(object):
         uppercase   ::= "A"..."Z"
         digit       ::= "0"..."9"
 
+        The tokens are read in a single pass. Only the first token is checked
+        against the command's name and aliases, and it is skipped if it matches.
+
         Args:
         tokens  - The list of tokens, the result of input_string.split()
 
@@ -111,23 +122,21 @@ class Command(object):
         args = []
         kwargs = {}
         current_key = None
-        parsing_named = False
-        for token in tokens:
-            if token == self.name or token in self.aliases:
-                continue
-            if "-" not in token:
-                if not parsing_named:
-                    args.append(token)
-                else:
-                    kwargs[current_key] = token
-                    parsing_named = False
-            else:
-                if not parsing_named:
-                    parsing_named = True
-                    current_key = token.strip("-")
-                else:
+        start = 0
+        if tokens and (tokens[0] == self.name or tokens[0] in self.aliases):
+            start = 1
+        for i in range(start, len(tokens)):
+            token = tokens[i]
+            if "-" in token:
+                if current_key is not None:
                     raise ParseException("Unexpected '-' in command input")
-        if parsing_named:
+                current_key = token.strip("-")
+            elif current_key is None:
+                args.append(token)
+            else:
+                kwargs[current_key] = token
+                current_key = None
+        if current_key is not None:
             raise ParseException("Unexpected end of command input")
         return (args, kwargs)
 
@@ -218,8 +227,10 @@ class Command(object):
         """
         if alias not in self.aliases:
             self.aliases.append(alias)
+            for menu in list(self._menus):
+                menu._add_alias(self, alias)
 
-    def _tabcomplete(self, buff):
+    def _tabcomplete(self, buff, cache=None, runner=None, matcher=None):
         """
         Get a list of possible completions for the current buffer, called when
         the user presses Tab.
@@ -242,18 +253,48 @@ class Command(object):
         testcommand my_arg
         the corresponding tabcomplete hook can be found in self.tabcomplete_hooks['my_arg']
 
+        Slow hooks can be given a timeout in self.tabcomplete_timeouts, in which
+        case they are called through runner. See _call_hook() for details.
+
+        With a matcher, the hook is called with an empty fragment to get every
+        candidate, and the fragment is fuzzy matched against them, so hooks
+        should return all their candidates for an empty fragment.
+
         Args:
         buff    - The string buffer representing the current unfinished command input
 
+        Kwargs:
+        cache   - A candela.completion.CompletionCache holding earlier hook results
+        runner  - A candela.completion.HookRunner used for hooks with a timeout
+        matcher - A candela.completion.FuzzyMatcher, or None to complete
+                  only candidates starting with the fragment
+
         Return:
         A list of completion strings for the current token in the command
         """
-        def __default(frag):
+        arg_name = self._completion_target(buff)
+        if arg_name not in self.tabcomplete_hooks:
             return []
-        func = __default
+        func = self.tabcomplete_hooks[arg_name]
+        frag = buff.split()[-1]
+        if buff.endswith(' '):
+            return self._call_hook(func, arg_name, frag, cache, runner)
+        if matcher is not None:
+            return matcher.match(self._call_hook(func, arg_name, "", cache, runner), frag)
+        results = self._call_hook(func, arg_name, frag, cache, runner, narrow=True)
+        return [a for a in results if a.startswith(frag)]
+
+    def _completion_target(self, buff):
+        """
+        Partially parse an unfinished command input and return the name of the
+        argument currently being typed, or None if it can't be determined
+
+        Args:
+        buff    - The string buffer representing the current unfinished command input
+        """
         tokens = buff.split()
         if '-' in tokens[-1] and not buff.endswith(' '):
-            return []
+            return None
         if len(tokens) >= 2:
             if buff.endswith(' '):
                 arg_is_named = '-' in tokens[-1]
@@ -269,7 +310,7 @@ class Command(object):
                     flag_index = -1
                 arg_name, reqd = self.kwargs[tokens[flag_index].strip('-')]
             except:
-                return __default(tokens[-1])
+                return None
         else:
             arg_index = len(tokens) - (2 * num_named)
             if buff.endswith(' '):
@@ -279,13 +320,106 @@ class Command(object):
             try:
                 arg_name = self.args[arg_index]
             except:
-                return __default(tokens[-1])
-        if arg_name in self.tabcomplete_hooks:
-            func = self.tabcomplete_hooks[arg_name]
-        results = func(tokens[-1])
-        if buff.endswith(' '):
+                return None
+        return arg_name
+
+    def _call_hook(self, func, arg_name, frag, cache, runner, narrow=False):
+        """
+        Get the results of a tabcomplete hook, calling it only when necessary
+
+        Results are looked up in the cache by (command, argument, fragment)
+        first. If narrow is True, results cached for a shorter prefix of the
+        fragment are filtered instead of calling the hook again, unless
+        filtering leaves nothing.
+
+        If the argument has an entry in self.tabcomplete_timeouts, the hook
+        runs on the runner's thread. Should it not finish in time, no
+        completions are offered, but its results are still cached when it
+        finishes, ready for the next Tab press.
+
+        Args:
+        func        - The tabcomplete hook
+        arg_name    - The name of the argument being completed
+        frag        - The fragment to pass to the hook
+        cache       - A CompletionCache, or None to always call the hook
+        runner      - A HookRunner, or None to always call the hook directly
+
+        Kwargs:
+        narrow      - Whether results for a prefix of frag may be used
+        """
+        results = self._cached_completions(arg_name, frag, cache, narrow)
+        if results is not None:
             return results
-        return [a for a in results if a.startswith(tokens[-1])]
+
+        # the list the cache stores is the one returned, so that a fuzzy
+        # matcher sees the same list on the next Tab press
+        key = (self, arg_name, frag)
+        stored = []
+        def _store(results):
+            if cache is not None:
+                stored.append(cache.put(key, results))
+
+        timeout = self.tabcomplete_timeouts.get(arg_name)
+        if runner is None or timeout is None:
+            results = func(frag)
+            _store(results)
+        else:
+            results = runner.run(func, frag, timeout, _store)
+            if results is None:
+                return []
+        return stored[-1] if stored else results
+
+    def _cached_completions(self, arg_name, frag, cache, narrow):
+        """
+        Return the cached results of this command's hook for an argument
+        fragment, or None if the hook needs to be called
+
+        Args:
+        arg_name    - The name of the argument being completed
+        frag        - The fragment that would be passed to the hook
+        cache       - A CompletionCache, or None
+        narrow      - Whether results for a prefix of frag may be used
+        """
+        if cache is None:
+            return None
+        results = cache.get((self, arg_name, frag))
+        if results is None and narrow:
+            # an empty result means the prefix's results don't cover frag
+            results = cache.narrow(self, arg_name, frag) or None
+        return results
+
+
+class ArgSpec(object):
+    """
+    What the default validator checks command input against, compiled once
+    from a command's definition.
+
+    ArgSpecs are immutable. They hold the set of required flags and the
+    number of arguments a valid command input must contain at least.
+    """
+    __slots__ = ('required', 'min_count')
+
+    def __init__(self, args, kwargs):
+        """
+        Args:
+        args    - The list of positional argument names, as returned by
+                  Command.parse_definition()
+        kwargs  - The dictionary of flag: (argument name, required) pairs, as
+                  returned by Command.parse_definition()
+        """
+        required = frozenset(k for k, (name, reqd) in kwargs.items() if reqd)
+        _set = super(ArgSpec, self).__setattr__
+        _set('required', required)
+        _set('min_count', len(args) + len(required))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ArgSpec is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("ArgSpec is immutable")
+
+    def __repr__(self):
+        return "<ArgSpec required=%r min_count=%d>" % (sorted(self.required), self.min_count)
 
 
 class BackCommand(Command):
@@ -0,0 +1,445 @@
+"""
+This file is part of Candela.
+
+Candela is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Candela is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Candela.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import sys
+import heapq
+import threading
+import time
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
+from itertools import compress, count, repeat
+from operator import add, contains, ge, itemgetter, sub
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+_local = threading.local()
+
+# the number of seconds a HookRunner's extra worker threads wait for another
+# hook before exiting
+WORKER_IDLE_TIMEOUT = 30
+
+# str.find(), for lists of strings that on python 2 may mix str and unicode
+if sys.version_info[0] >= 3:
+    _find = str.find
+else:
+    def _find(text, sub, start=0):
+        return text.find(sub, start)
+
+
+def is_cancelled():
+    """
+    Return True if the tab completion hook calling this has gone stale.
+
+    Hooks run by a HookRunner can call this while doing slow work and stop
+    early, since a newer keystroke means nobody is waiting for their result.
+    """
+    call = getattr(_local, 'call', None)
+    return call is not None and call.cancelled()
+
+
+class CompletionCache(object):
+    """
+    Remembers the results of tab completion hooks.
+
+    Entries are keyed by (command, argument name, fragment). The least
+    recently used entry is evicted once maxsize is reached, and entries
+    older than ttl seconds are never returned.
+    """
+    def __init__(self, maxsize=256, ttl=10):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # results are stored from the hook runner's thread
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached results for key, or None
+
+        Args:
+        key     - The (command, argument name, fragment) tuple
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            stamp, results = entry
+            if self.ttl is not None and time.time() - stamp > self.ttl:
+                return None
+            self._entries[key] = entry
+            return results
+
+    def put(self, key, results):
+        """
+        Store the results of a hook call
+
+        Args:
+        key     - The (command, argument name, fragment) tuple
+        results - The list of completions the hook returned
+
+        Return:
+        The copy of results that was stored, which get() returns from now on
+        """
+        results = list(results)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), results)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return results
+
+    def narrow(self, command, arg_name, frag):
+        """
+        Return completions for frag derived from the results cached for the
+        longest prefix of frag, or None if no prefix has cached results.
+
+        This lets further typing filter earlier results locally instead of
+        calling the hook again.
+
+        Args:
+        command     - The Command the hook belongs to
+        arg_name    - The name of the argument being completed
+        frag        - The fragment of the argument typed so far
+        """
+        for end in range(len(frag), -1, -1):
+            results = self.get((command, arg_name, frag[:end]))
+            if results is not None:
+                return [a for a in results if a.startswith(frag)]
+        return None
+
+    def clear(self):
+        """
+        Forget all cached results
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class FuzzyMatcher(object):
+    """
+    Matches tab completions against a fragment typed with letters missing.
+
+    A candidate matches if the characters of the fragment all appear in it
+    in order, ignoring case. Matches are ranked by how close together those
+    characters are, then by how early they start, then by length, so exact
+    prefixes of short names come first.
+
+    Each list of candidates is prepared the first time it is matched
+    against, and the last maxsize lists are remembered by identity, so they
+    must not be modified afterwards. A new list equal to a remembered one,
+    such as the same results from a hook called again, takes over its
+    preparation rather than being prepared again. Preparing a list finds the candidates
+    containing each of its characters, so that a fragment is only checked
+    against the candidates containing all of its characters. A single
+    character only looks at the candidates starting with it when there are
+    enough of them. When the fragment grows by a keystroke, only the
+    candidates that matched it before are checked again, and only for the
+    characters added.
+    """
+    def __init__(self, limit=100, maxsize=8):
+        """
+        Kwargs:
+        limit   - The most completions returned by match()
+        maxsize - The number of candidate lists remembered
+        """
+        self.limit = limit
+        self.maxsize = maxsize
+        self._indexes = OrderedDict()
+
+    def match(self, candidates, frag):
+        """
+        Return up to limit of the candidates matching frag, best first
+
+        Args:
+        candidates  - The list of completion strings
+        frag        - The fragment typed so far
+        """
+        key = id(candidates)
+        index = self._indexes.pop(key, None)
+        if index is None or index.candidates is not candidates:
+            index = self._take_equal(candidates)
+            if index is None:
+                index = _FuzzyIndex(candidates)
+            if len(self._indexes) >= self.maxsize:
+                self._indexes.popitem(last=False)
+        self._indexes[key] = index
+        return index.match(frag, self.limit)
+
+    def _take_equal(self, candidates):
+        """
+        Return the index prepared for a list equal to candidates, moved over
+        to candidates, or None if there is none
+        """
+        for key, index in self._indexes.items():
+            if len(index.candidates) == len(candidates) and index.candidates == candidates:
+                del self._indexes[key]
+                index.candidates = candidates
+                return index
+        return None
+
+    def clear(self):
+        """
+        Forget all prepared candidate lists
+        """
+        self._indexes.clear()
+
+
+class _FuzzyIndex(object):
+    """
+    One list of candidates prepared for a FuzzyMatcher.
+
+    The candidates are numbered shortest first, so that ties are broken by
+    comparing numbers. For every character, the candidates containing it
+    are kept as a mask with one byte per candidate, and the candidates that
+    could match a fragment are found by ANDing the masks of its characters.
+    They are then checked and scored a whole list at a time with map(),
+    compress() and heapq, leaving no python loop over the candidates.
+    """
+    def __init__(self, candidates):
+        self.candidates = candidates
+        lengths = list(map(len, candidates))
+        self._order = sorted(range(len(candidates)), key=lengths.__getitem__)
+        lowered = self._lowered = [candidates[n].lower() for n in self._order]
+        size = len(lowered)
+        self._masks = {}
+        for char in set("".join(lowered)):
+            self._masks[char] = _to_mask(map(contains, lowered, repeat(char, size)))
+        # the first character of each candidate, for finding those that
+        # start with a character without looking at the rest. empty
+        # candidates sort first and get a newline, which is never typed
+        empty = lengths.count(0)
+        self._firsts = "\n" * empty + "".join(map(itemgetter(0), lowered[empty:]))
+        # the last fragment matched, and if they were all found, the numbers
+        # of its matches with where each match starts and ends
+        self._frag = None
+        self._matches = None
+
+    def match(self, frag, limit):
+        frag = frag.lower()
+        if not frag:
+            return self.candidates[:limit]
+        if len(frag) == 1:
+            best = self._starting_with(frag, limit)
+            if best is not None:
+                self._frag = frag
+                self._matches = None
+                return best
+        if self._matches is not None and frag.startswith(self._frag):
+            numbers, starts, ends = self._matches
+            rest = frag[len(self._frag):]
+        else:
+            # the leftmost match starts at the first occurrence of the first
+            # character, since any later start matches less
+            numbers = self._containing(frag)
+            starts = list(map(_find, map(self._lowered.__getitem__, numbers),
+                              repeat(frag[0], len(numbers))))
+            ends = list(map(add, starts, repeat(1, len(starts))))
+            rest = frag[1:]
+        # each further character is matched by its first occurrence after
+        # the one before
+        for char in rest:
+            found = list(map(_find, map(self._lowered.__getitem__, numbers),
+                             repeat(char, len(numbers)), ends))
+            keep = list(map(ge, found, repeat(0, len(found))))
+            numbers = list(compress(numbers, keep))
+            starts = list(compress(starts, keep))
+            ends = list(map(add, compress(found, keep), repeat(1, len(numbers))))
+        self._frag = frag
+        self._matches = (numbers, starts, ends)
+        best = heapq.nsmallest(limit, zip(map(sub, ends, starts), starts, numbers))
+        return [self.candidates[self._order[entry[2]]] for entry in best]
+
+    def _starting_with(self, char, limit):
+        """
+        Return the best limit candidates for a single character if at least
+        that many start with it, or None. Every match of one character has
+        the same gap, so those starting with it come first, shortest first
+        """
+        best = []
+        pos = self._firsts.find(char)
+        while pos >= 0 and len(best) < limit:
+            best.append(self.candidates[self._order[pos]])
+            pos = self._firsts.find(char, pos + 1)
+        if len(best) < limit:
+            return None
+        return best
+
+    def _containing(self, frag):
+        """
+        Return the numbers of the candidates containing every character of
+        frag, in any order
+        """
+        mask = -1
+        for char in set(frag):
+            mask &= self._masks.get(char, 0)
+        return _from_mask(mask, len(self._lowered))
+
+
+def _to_mask(flags):
+    """
+    Pack flags into an integer, one byte per flag with the first flag in
+    the lowest byte
+    """
+    data = bytearray(flags)
+    data.reverse()
+    return int(hexlify(data), 16) if data else 0
+
+
+def _from_mask(mask, size):
+    """
+    Return the positions of the set flags in a mask made by _to_mask()
+
+    Args:
+    mask    - The mask
+    size    - The number of flags it holds
+    """
+    if not size or mask == 0:
+        return []
+    data = bytearray(unhexlify("%0*x" % (2 * size, mask & ((1 << 8 * size) - 1))))
+    data.reverse()
+    return list(compress(count(), data))
+
+
+class _HookCall(object):
+    """
+    One pending or running call to a tab completion hook
+    """
+    def __init__(self, runner, hook, frag, callback):
+        self.runner = runner
+        self.hook = hook
+        self.frag = frag
+        self.callback = callback
+        self.generation = runner._generation
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+    def cancelled(self):
+        return self.generation != self.runner._generation
+
+
+class HookRunner(object):
+    """
+    Runs tab completion hooks on background threads, so that a slow hook
+    cannot freeze the shell.
+
+    The shell waits for a hook for at most its timeout. A hook that takes
+    longer keeps running, and its results are handed to a callback when it
+    finishes, usually to be cached for the next Tab press. Calling cancel()
+    marks every outstanding call as stale: calls that have not started yet
+    are skipped, and running hooks can notice by checking is_cancelled().
+
+    Hooks normally run one at a time on a single thread. When a hook is
+    called while every thread is still busy with an earlier one, such as a
+    hook that hangs without checking is_cancelled(), another thread is
+    started, up to max_workers. Those extra threads exit once they have
+    been idle for WORKER_IDLE_TIMEOUT seconds.
+    """
+    def __init__(self, max_workers=4):
+        """
+        Kwargs:
+        max_workers - The most hooks run at once
+        """
+        self.max_workers = max_workers
+        self._queue = queue.Queue()
+        self._generation = 0
+        # the number of worker threads, and how many of them are waiting for
+        # a call. calls are queued holding the lock, so that an idle thread
+        # can't exit while a call is about to be handed to it
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._idle = 0
+
+    def run(self, hook, frag, timeout, callback=None):
+        """
+        Call hook(frag) on the worker thread and wait for its results
+
+        Returns the list of completions, or None if the hook did not finish
+        within timeout seconds. Exceptions raised by the hook in time are
+        re-raised here.
+
+        Args:
+        hook        - The tab completion hook
+        frag        - The fragment to pass to the hook
+        timeout     - The number of seconds to wait
+
+        Kwargs:
+        callback    - Called on the worker thread with the results whenever
+                      the hook succeeds, even after the timeout
+        """
+        call = _HookCall(self, hook, frag, callback)
+        with self._lock:
+            if not self._idle and self._workers < self.max_workers:
+                # the first thread lasts, the others only while they are needed
+                idle_timeout = WORKER_IDLE_TIMEOUT if self._workers else None
+                self._workers += 1
+                self._idle += 1
+                thread = threading.Thread(target=self._work, args=(idle_timeout,))
+                thread.daemon = True
+                thread.start()
+            self._queue.put(call)
+        call.done.wait(timeout)
+        if not call.done.is_set():
+            return None
+        if call.error is not None:
+            raise call.error
+        return call.results
+
+    def cancel(self):
+        """
+        Mark every call made so far as stale
+        """
+        self._generation += 1
+
+    def _work(self, idle_timeout):
+        while True:
+            try:
+                call = self._queue.get(timeout=idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    if self._queue.empty():
+                        self._workers -= 1
+                        self._idle -= 1
+                        return
+                continue
+            with self._lock:
+                self._idle -= 1
+            self._call(call)
+            with self._lock:
+                self._idle += 1
+
+    def _call(self, call):
+        """
+        Run one queued call on the current worker thread, unless it has
+        gone stale
+        """
+        if call.cancelled():
+            call.done.set()
+            return
+        _local.call = call
+        try:
+            call.results = call.hook(call.frag)
+        except Exception as e:
+            call.error = e
+        finally:
+            _local.call = None
+        if call.error is None and call.callback:
+            call.callback(call.results)
+        call.done.set()
@@ -0,0 +1,432 @@
+"""
+This file is part of Candela.
+
+Candela is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Candela is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Candela.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import sys
+import math
+import mmap
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # not available on windows
+    fcntl = None
+
+# how search results are ranked: each doubling of the number of times a
+# command was entered counts as much as having entered it this many
+# commands later
+FREQUENCY_WEIGHT = 20
+# queries too short to look up in the index are matched against this many
+# of the most recently entered distinct commands
+SHORT_QUERY_LIMIT = 1000
+# while the search index is being built, searches only look at the commands
+# in this many bytes at the end of the history
+UNINDEXED_BYTES = 1 << 18
+# the number of bytes of the history indexed at a time
+INDEX_CHUNK = 1 << 16
+
+
+class History(object):
+    """
+    The commands entered at the prompt, oldest first, for the Up and Down
+    arrows to cycle through.
+
+    With a path, commands are appended to that file, one per line, and are
+    shared with earlier sessions and with other shells using the same file.
+    The file is memory-mapped rather than read in, and moving to the
+    previous or next command only scans that command's line, so neither
+    starting up nor pressing a key depends on the size of the file. Each
+    command is added with a single write to a file opened for appending,
+    under an exclusive lock where the platform has one, so concurrent
+    shells never interleave their lines.
+
+    Without a path, the history is kept in memory for this session only.
+    """
+    def __init__(self, path=None):
+        """
+        Kwargs:
+        path    - The file to keep the history in. It is created if it
+                  does not exist
+        """
+        self.path = path
+        self._fd = None
+        if path is not None:
+            self._fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+        # the history as newline-terminated lines: a read-only map of the
+        # file, or the lines themselves when there is no file
+        self._data = bytearray()
+        # the size of the file when it was last mapped
+        self._mapped = 0
+        # the number of bytes in complete lines, and the offset of the
+        # start of the line currently shown, or _end if none is
+        self._end = 0
+        self._pos = 0
+        # the last command added, so that repeats are only stored once
+        self._last = None
+        # the search index, built on a background thread when the first
+        # search starts and extended with the commands added since by later
+        # ones. the lock keeps the file from being remapped while the
+        # thread reads it
+        self._index = None
+        self._indexer = None
+        self._lock = threading.Lock()
+
+        self.reset()
+
+    def append(self, command):
+        """
+        Add a command to the end of the history. Blank commands, and
+        commands equal to the one just added, are ignored
+
+        Args:
+        command - The command string. Must not contain newlines
+        """
+        if not command.strip() or command == self._last:
+            return
+        self._last = command
+        line = _encode(command) + b"\n"
+        if self._fd is None:
+            self._data += line
+            return
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            # a shell that died while writing may have left a partial line
+            size = os.fstat(self._fd).st_size
+            if size:
+                os.lseek(self._fd, size - 1, os.SEEK_SET)
+                if os.read(self._fd, 1) != b"\n":
+                    line = b"\n" + line
+            os.write(self._fd, line)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def reset(self):
+        """
+        Pick up commands added since the last reset, including those added by
+        other shells, and move back past the newest command
+        """
+        if self._fd is not None:
+            size = os.fstat(self._fd).st_size
+            if size != self._mapped:
+                with self._lock:
+                    self._close_map()
+                    if size:
+                        self._data = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+                    self._mapped = size
+        # ignore a partly written last line
+        self._end = self._data.rfind(b"\n") + 1
+        self._pos = self._end
+
+    def older(self):
+        """
+        Move to the command before the current one and return it, or return
+        None if there is none
+        """
+        if self._pos == 0:
+            return None
+        start = self._data.rfind(b"\n", 0, self._pos - 1) + 1
+        command = self._data[start:self._pos - 1]
+        self._pos = start
+        return _decode(command)
+
+    def newer(self):
+        """
+        Move to the command after the current one and return it. Moving past
+        the newest command returns the empty string, and after that None
+        """
+        if self._pos == self._end:
+            return None
+        self._pos = self._data.find(b"\n", self._pos) + 1
+        if self._pos == self._end:
+            return ""
+        return _decode(self._data[self._pos:self._data.find(b"\n", self._pos)])
+
+    def search(self, query):
+        """
+        Return the commands containing query, best match first.
+
+        Commands are ranked by when they were last entered, and how often.
+        Longer queries are looked up in a trigram index, so only commands
+        sharing the query's rarest trigram are checked. Queries shorter than
+        three characters only look at recent commands. The first search
+        waits for the index to be built, which takes a while for a long
+        history.
+
+        Args:
+        query   - The text to search for
+        """
+        return self._ready_index(wait=True).match(query)
+
+    def _ready_index(self, wait=False):
+        """
+        Return the search index, updated with the commands added since it
+        was last used, or None if it is still being built. The first call
+        starts building it on a background thread.
+
+        Kwargs:
+        wait    - Wait for the index to be built rather than return None
+        """
+        index = self._index
+        if index is not None and index.size > self._end:
+            # the file was truncated. start over
+            index = self._index = None
+        if index is None:
+            if self._indexer is None or not self._indexer.is_alive():
+                self._indexer = threading.Thread(target=self._build_index, args=(self._end,))
+                self._indexer.daemon = True
+                self._indexer.start()
+            if not wait:
+                return None
+            self._indexer.join()
+            index = self._index
+        if index.size < self._end:
+            index.add(*self._read(index.size, self._end))
+        return index
+
+    def _build_index(self, end):
+        index = _SearchIndex()
+        # a chunk at a time, since decoding the whole history at once would
+        # hold the interpreter lock and stall the shell's thread
+        step = INDEX_CHUNK
+        while index.size < end:
+            lines, size = self._read(index.size, min(index.size + step, end))
+            if size > index.size:
+                index.add(lines, size)
+            elif index.size + step < end:
+                # a line longer than the chunk
+                step *= 2
+            else:
+                # the history was closed or truncated
+                break
+        self._index = index
+
+    def _read(self, start, end):
+        """
+        Return the commands in the complete lines between two offsets, and
+        the offset after the last of them
+        """
+        with self._lock:
+            data = self._data[start:end]
+        data = data[:data.rfind(b"\n") + 1]
+        return _decode(data).split("\n")[:-1], start + len(data)
+
+    def _match_recent(self, query):
+        """
+        Return the commands near the end of the history containing query,
+        most recent first, for searching before the index is ready
+        """
+        start = max(self._end - UNINDEXED_BYTES, 0)
+        if start:
+            start = self._data.find(b"\n", start - 1) + 1
+        lines = _decode(self._data[start:self._end]).split("\n")[:-1]
+        seen = set()
+        matches = []
+        for command in reversed(lines):
+            if query in command and command not in seen:
+                seen.add(command)
+                matches.append(command)
+        return matches
+
+    def _close_map(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = bytearray()
+        self._mapped = 0
+
+    def close(self):
+        """
+        Release the history file
+        """
+        with self._lock:
+            self._close_map()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class _SearchIndex(object):
+    """
+    The commands in a History, indexed for searching.
+
+    Each distinct command has an id, its position in commands, and the ids
+    of the commands containing each trigram are kept in ascending order.
+    """
+    def __init__(self):
+        # the number of bytes of the history indexed
+        self.size = 0
+        self.ids = {}
+        self.commands = []
+        self.grams = {}
+        # for each command id, how many times it was entered and its rank
+        self.uses = []
+        self.scores = []
+        self.entered = 0
+        # the command ids, least recently entered first
+        self.recent = OrderedDict()
+
+    def add(self, lines, size):
+        """
+        Add the commands entered since the last call
+
+        Args:
+        lines   - The commands, oldest first
+        size    - The number of bytes of the history indexed after them
+        """
+        self.size = size
+        ids, commands, grams = self.ids, self.commands, self.grams
+        uses, scores, recent = self.uses, self.scores, self.recent
+        for command in lines:
+            self.entered += 1
+            n = ids.get(command)
+            if n is None:
+                n = ids[command] = len(commands)
+                commands.append(command)
+                uses.append(0)
+                scores.append(0)
+                for gram in set(zip(command, command[1:], command[2:])):
+                    postings = grams.get(gram)
+                    if postings is None:
+                        grams[gram] = [n]
+                    else:
+                        postings.append(n)
+            else:
+                del recent[n]
+            recent[n] = None
+            uses[n] += 1
+            # recency, counted in commands entered, plus the bonus for
+            # frequent use
+            scores[n] = self.entered + FREQUENCY_WEIGHT * math.log(uses[n], 2)
+
+    def match(self, query, within=None):
+        """
+        Return the commands containing query, best match first
+
+        Args:
+        query   - The text to search for
+
+        Kwargs:
+        within  - A ranked list of commands known to contain every match,
+                  such as the matches for the start of query
+        """
+        if within is not None:
+            return [command for command in within if query in command]
+        commands = self.commands
+        if len(query) < 3:
+            matches = []
+            for n in reversed(self.recent):
+                if query in commands[n]:
+                    matches.append(n)
+                    if len(matches) == SHORT_QUERY_LIMIT:
+                        break
+        else:
+            grams = self.grams
+            postings = min([grams.get(gram, ()) for gram in zip(query, query[1:], query[2:])],
+                           key=len)
+            matches = [n for n in postings if query in commands[n]]
+        matches.sort(key=self.scores.__getitem__, reverse=True)
+        return [commands[n] for n in matches]
+
+
+class HistorySearch(object):
+    """
+    An incremental search through a History, as run by Ctrl-R.
+
+    Each character added to the query narrows the matches for the query
+    before it instead of searching again, and removing it goes back to
+    them. The best match is shown first, and next_match() moves on
+    to the next best.
+
+    Starting a search never waits for the history's index to be built.
+    Until it is ready, only the most recent commands are searched, most
+    recent first.
+    """
+    def __init__(self, history):
+        """
+        Args:
+        history - The History to search
+        """
+        history._ready_index()
+        self.history = history
+        self.query = ""
+        # the commands matching query, best first, which of them is shown,
+        # and whether they were found with the index
+        self.matches = []
+        self.index = 0
+        self._indexed = False
+        # the query, matches, index and _indexed before each character was
+        # added
+        self._previous = []
+
+    @property
+    def match(self):
+        """
+        The command currently shown, or None if nothing matches
+        """
+        if not self.query or not self.matches:
+            return None
+        return self.matches[self.index]
+
+    def add(self, text):
+        """
+        Append text to the query
+
+        Args:
+        text    - The characters to add
+        """
+        self._previous.append((self.query, self.matches, self.index, self._indexed))
+        index = self.history._ready_index()
+        if index is not None:
+            # matches for short queries are not complete, so they are only
+            # narrowed down once the index has been used
+            within = self.matches if self._indexed and len(self.query) >= 3 else None
+            self.matches = index.match(self.query + text, within)
+        elif self.query and not self._indexed:
+            self.matches = [command for command in self.matches if self.query + text in command]
+        else:
+            self.matches = self.history._match_recent(self.query + text)
+        self.query += text
+        self._indexed = index is not None
+        self.index = 0
+
+    def remove(self):
+        """
+        Remove the last character added to the query
+        """
+        if self._previous:
+            self.query, self.matches, self.index, self._indexed = self._previous.pop()
+
+    def next_match(self):
+        """
+        Move on to the next best match, if there is one
+        """
+        if self.index + 1 < len(self.matches):
+            self.index += 1
+
+
+def _encode(command):
+    if sys.version_info[0] >= 3 or isinstance(command, unicode):
+        return command.encode('utf-8')
+    return command
+
+
+def _decode(data):
+    data = bytes(data)
+    if sys.version_info[0] >= 3:
+        return data.decode('utf-8', 'replace')
+    return data
@@ -0,0 +1,305 @@
+"""
+This file is part of Candela.
+
+Candela is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Candela is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Candela.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import itertools
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+_local = threading.local()
+
+
+def current_job():
+    """
+    Return the Job running on the calling thread, or None.
+
+    Long-running job functions use this to report progress and to check
+    whether they have been cancelled:
+
+    def _scan(paths):
+        job = current_job()
+        for i, path in enumerate(paths):
+            if job.cancelled():
+                return
+            job.set_progress(float(i) / len(paths))
+            # ...
+    """
+    return getattr(_local, 'job', None)
+
+
+class Job(object):
+    """
+    A function call scheduled on a Scheduler, and the handle to its result.
+
+    A job can only be cancelled cooperatively: cancel() stops a pending job
+    from starting, but a running job keeps going until its function checks
+    cancelled() and returns.
+    """
+    def __init__(self, scheduler, id, func, args, kwargs, name=None,
+                 timeout=None, default=None):
+        self.scheduler = scheduler
+        self.id = id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.name = name or getattr(func, '__name__', 'job')
+        self.default = default
+        # the time after which the job counts as cancelled
+        self.deadline = time.time() + timeout if timeout is not None else None
+
+        self.status = PENDING
+        # the fraction of the work done, between 0 and 1, or None if unknown
+        self.progress = None
+        self.message = ""
+        self.error = None
+        self._result = default
+        self._cancelled = False
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """
+        Ask the job to stop. Returns False if it had already finished
+        """
+        if self.done():
+            return False
+        self._cancelled = True
+        self.scheduler._changed(self)
+        return True
+
+    def cancelled(self):
+        """
+        Return True if the job has been cancelled or has run past its timeout
+        """
+        if self._cancelled:
+            return True
+        return self.deadline is not None and time.time() > self.deadline
+
+    def done(self):
+        """
+        Return True if the job has finished, failed or been cancelled
+        """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the job is done or timeout seconds pass. Returns done()
+        """
+        self._done.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        """
+        Wait for the job and return the value its function returned.
+
+        A cancelled job or one that is still running after timeout seconds
+        returns the job's default value. If the function raised an exception,
+        it is re-raised here.
+        """
+        self.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self._result
+
+    def set_progress(self, progress=None, message=None):
+        """
+        Report how far the job has come
+
+        Kwargs:
+        progress    - The fraction of the work done, between 0 and 1
+        message     - A short description of the current step
+        """
+        if progress is not None:
+            self.progress = max(0.0, min(1.0, progress))
+        if message is not None:
+            self.message = message
+        self.scheduler._changed(self)
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(job) once the job is done. The scheduler decides which
+        thread the call is made on; a Shell makes it on the UI thread.
+
+        Args:
+        callback    - The function to call with the job
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        self.scheduler._deliver(callback, self)
+
+    def describe(self):
+        """
+        Return a one-line summary of the job's status
+        """
+        text = "[%d] %s: %s" % (self.id, self.name, self.status)
+        if self.status == RUNNING:
+            if self.cancelled():
+                text += " (cancelling)"
+            elif self.progress is not None:
+                text += " %d%%" % (self.progress * 100)
+        if self.message:
+            text += " - %s" % self.message
+        return text
+
+    def _finish(self, status, result=None, error=None):
+        self.status = status
+        if status == DONE:
+            self._result = result
+        self.error = error
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        self.scheduler._changed(self)
+        for callback in callbacks:
+            self.scheduler._deliver(callback, self)
+
+    def __repr__(self):
+        return "<Job %s>" % self.describe()
+
+
+class Scheduler(object):
+    """
+    Runs jobs on a bounded pool of worker threads.
+
+    Threads are started as jobs are submitted, up to max_workers, and are
+    reused for later jobs. Jobs beyond that wait in a queue.
+    """
+    def __init__(self, max_workers=4, deliver=None, on_change=None):
+        """
+        Kwargs:
+        max_workers - The largest number of jobs run at the same time
+        deliver     - Called as deliver(callback, job) to run a done callback.
+                      If None, callbacks are called on the worker thread
+        on_change   - Called with a job from any thread whenever its status
+                      or progress changes
+        """
+        self.max_workers = max_workers
+        self.deliver = deliver
+        self.on_change = on_change
+        # the jobs that have not finished, by id
+        self.jobs = {}
+        self._ids = itertools.count(1)
+        self._queue = queue.Queue()
+        self._threads = []
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, args=(), kwargs={}, name=None, timeout=None,
+               default=None, callback=None):
+        """
+        Schedule func(*args, **kwargs) to run on a worker thread
+
+        Args:
+        func        - The function to run
+
+        Kwargs:
+        args        - The arguments to pass to func
+        kwargs      - The keyword arguments to pass to func
+        name        - The name to show for the job. Defaults to func's name
+        timeout     - The number of seconds after which the job counts as
+                      cancelled
+        default     - The result of the job if it is cancelled
+        callback    - Called with the job once it is done
+
+        Return:
+        The Job
+        """
+        with self._lock:
+            job = Job(self, next(self._ids), func, args, kwargs, name=name,
+                      timeout=timeout, default=default)
+            self.jobs[job.id] = job
+            if callback is not None:
+                job.add_done_callback(callback)
+            if self._idle == 0 and len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+            else:
+                self._idle -= 1
+        self._queue.put(job)
+        self._changed(job)
+        return job
+
+    def get(self, id):
+        """
+        Return the unfinished job with the given id, or None
+        """
+        return self.jobs.get(id)
+
+    def busy(self):
+        """
+        Return True if any job has not finished
+        """
+        return len(self.jobs) > 0
+
+    def cancel_all(self):
+        """
+        Cancel every unfinished job
+        """
+        for job in list(self.jobs.values()):
+            job.cancel()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job.cancelled():
+                self._complete(job, CANCELLED)
+                continue
+            job.status = RUNNING
+            self._changed(job)
+            _local.job = job
+            try:
+                result = job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                self._complete(job, FAILED, error=e)
+            else:
+                if job.cancelled():
+                    self._complete(job, CANCELLED)
+                else:
+                    self._complete(job, DONE, result=result)
+            finally:
+                _local.job = None
+
+    def _complete(self, job, status, result=None, error=None):
+        with self._lock:
+            self.jobs.pop(job.id, None)
+            self._idle += 1
+        job._finish(status, result=result, error=error)
+
+    def _changed(self, job):
+        if self.on_change is not None:
+            self.on_change(job)
+
+    def _deliver(self, callback, job):
+        if self.deliver is None:
+            callback(job)
+        else:
+            self.deliver(callback, job)
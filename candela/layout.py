@@ -0,0 +1,72 @@
+"""
+This file is part of Candela.
+
+Candela is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Candela is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Candela.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import textwrap
+from collections import OrderedDict
+
+
+class WrapCache(object):
+    """
+    Splits lines of output into rows that fit the window, remembering the
+    result for each (line, width) pair.
+
+    textwrap is slow, and the same long lines tend to be wrapped again and
+    again: repeated log messages, and every visible line each time the
+    screen is redrawn. Lines that already fit are returned as they are
+    without touching the cache. The least recently used layout is evicted
+    once maxsize is reached.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._layouts = OrderedDict()
+        # a TextWrapper for each width, reused instead of building one for
+        # every line as textwrap.wrap() does
+        self._wrappers = {}
+        self.hits = 0
+        self.misses = 0
+
+    def wrap(self, line, width):
+        """
+        Return the tuple of rows line takes up in a window of the given width
+
+        Args:
+        line    - The line to lay out. Must not contain newlines
+        width   - The number of columns available
+        """
+        if len(line) <= width:
+            return (line,)
+        key = (line, width)
+        rows = self._layouts.pop(key, None)
+        if rows is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            wrapper = self._wrappers.get(width)
+            if wrapper is None:
+                wrapper = self._wrappers[width] = textwrap.TextWrapper(width)
+            # a line of nothing but whitespace wraps to no rows at all, but
+            # still takes up one
+            rows = tuple(wrapper.wrap(line)) or ("",)
+            if len(self._layouts) >= self.maxsize:
+                self._layouts.popitem(last=False)
+        self._layouts[key] = rows
+        return rows
+
+    def clear(self):
+        """
+        Forget all cached layouts
+        """
+        self._layouts.clear()
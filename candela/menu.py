@@ -14,8 +14,79 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with Candela.  If not, see <http://www.gnu.org/licenses/>.
 """
+from bisect import bisect_left, insort
 
-class Menu():
+
+class ObservedList(list):
+    """
+    A list that calls a function after every change to its contents.
+    Used to keep lookup indices in sync with lists that users of Candela
+    are free to assign to and modify, such as Menu.commands and Shell.menus.
+
+    Adding items is reported separately, so that an index can be extended
+    in place rather than rebuilt.
+    """
+    def __init__(self, on_change, items=(), on_add=None):
+        """
+        Args:
+        on_change   - Called with no arguments after any change
+
+        Kwargs:
+        items       - The initial contents
+        on_add      - Called as on_add(items, at_end) instead of on_change
+                      after items are added by append, extend, += or
+                      insert. at_end is True if they went after every
+                      item already in the list
+        """
+        list.__init__(self, items)
+        self._on_change = on_change
+        self._on_add = on_add
+
+    def _added(self, items, at_end):
+        if self._on_add is None:
+            self._on_change()
+        else:
+            self._on_add(items, at_end)
+
+    def append(self, item):
+        list.append(self, item)
+        self._added([item], True)
+
+    def extend(self, items):
+        start = len(self)
+        list.extend(self, items)
+        self._added(self[start:], True)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def insert(self, index, item):
+        at_end = index >= len(self)
+        list.insert(self, index, item)
+        self._added([item], at_end)
+
+    def copy(self):
+        return list(self)
+
+
+def _observed(name):
+    method = getattr(list, name)
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._on_change()
+        return result
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ['remove', 'pop', 'clear', 'sort', 'reverse',
+              '__setitem__', '__delitem__', '__imul__',
+              '__setslice__', '__delslice__']:
+    if hasattr(list, _name):
+        setattr(ObservedList, _name, _observed(_name))
+
+
+class Menu(object):
     """
     Simple representation of a menu: one state of the state machine
     created by Candela.
@@ -25,13 +96,137 @@ class Menu():
     def __init__(self, name):
         self.name = name
         self.title = ''
+        # maps every command name and alias to its Command
+        self._index = {}
+        # the keys of _index in sorted order, for prefix completion
+        self._names = []
+        # a copy of _names for fuzzy matchers, which remember the lists they
+        # are given by identity, so it is replaced whenever the names change
+        self._fuzzy_names = None
+        # bumped whenever the commands or their aliases change, so that
+        # text built from them can tell it is out of date
+        self.version = 0
+        self._options = None
         self.commands = []
 
+    @property
+    def commands(self):
+        """
+        The list of Command objects making up this menu.
+        It can be assigned to or modified in place.
+        """
+        return self._commands
+
+    @commands.setter
+    def commands(self, commands):
+        self._commands = ObservedList(self._reindex, commands, self._add)
+        self._reindex()
+
+    def get_command(self, name):
+        """
+        Return the Command whose name or alias is the given string, or None.
+        If several commands share a name, the first in the menu wins.
+
+        Args:
+        name    - The name or alias of the command
+        """
+        return self._index.get(name)
+
+    def complete(self, prefix, matcher=None):
+        """
+        Return the sorted list of command names and aliases starting with prefix
+
+        The names are kept sorted, so the matches are found by binary search
+        rather than by checking every command.
+
+        Args:
+        prefix  - The fragment of a command name to complete
+
+        Kwargs:
+        matcher - A candela.completion.FuzzyMatcher. If given, the names
+                  fuzzy matching prefix are returned instead, best first
+        """
+        if matcher is not None:
+            if self._fuzzy_names is None:
+                self._fuzzy_names = list(self._names)
+            return matcher.match(self._fuzzy_names, prefix)
+        lo = bisect_left(self._names, prefix)
+        if not prefix:
+            return self._names[lo:]
+        # the smallest string greater than every string starting with prefix
+        successor = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return self._names[lo:bisect_left(self._names, successor, lo)]
+
+    def _reindex(self):
+        """
+        Rebuild the name and alias index after the commands have changed
+        """
+        index = {}
+        for command in self._commands:
+            command._menus.add(self)
+            index.setdefault(command.name, command)
+            for alias in command.aliases:
+                index.setdefault(alias, command)
+        self._index = index
+        self._names = sorted(index)
+        self._changed()
+
+    def _add(self, commands, at_end):
+        """
+        Add newly added commands to the name and alias index
+
+        Args:
+        commands    - The Command objects added
+        at_end      - Whether they were added after every other command
+        """
+        names = []
+        for command in commands:
+            names.append((command.name, command))
+            names.extend((alias, command) for alias in command.aliases)
+        if not at_end and any(name in self._index for name, _ in names):
+            # a command inserted before another with the same name takes
+            # over that name
+            self._reindex()
+            return
+        for command in commands:
+            command._menus.add(self)
+        for name, command in names:
+            if name not in self._index:
+                self._index[name] = command
+                insort(self._names, name)
+        self._changed()
+
+    def _add_alias(self, command, alias):
+        """
+        Add a new alias of one of this menu's commands to the index
+
+        Args:
+        command - The Command the alias was added to
+        alias   - The new alias
+        """
+        if self._index.get(command.name) is not command and command not in self._commands:
+            # the command has since been removed from this menu
+            return
+        if alias in self._index:
+            # whichever command comes first keeps the name
+            self._reindex()
+            return
+        self._index[alias] = command
+        insort(self._names, alias)
+        self._changed()
+
+    def _changed(self):
+        self.version += 1
+        self._options = None
+        self._fuzzy_names = None
+
     def options(self):
         """
         Return the string representations of the options for this menu
+
+        The string is built once and kept until the commands or their
+        aliases change.
         """
-        ret = ""
-        for command in self.commands:
-            ret += "%s\n" % str(command)
-        return ret
+        if self._options is None:
+            self._options = "".join(["%s\n" % command for command in self.commands])
+        return self._options
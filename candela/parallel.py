@@ -0,0 +1,163 @@
+"""
+This file is part of Candela.
+
+Candela is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Candela is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Candela.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import multiprocessing
+import signal
+import time
+import traceback
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from candela import constants
+from candela.shell import NullRenderer
+
+# the timeout given to the pool when waiting for every script to finish
+_WAIT_FOREVER = 60 * 60 * 24 * 365
+
+
+class ScriptResult(object):
+    """
+    The outcome of running one script with run_scripts()
+    """
+    def __init__(self, script, exit_code, output, elapsed, error=None):
+        # the name of the script file
+        self.script = script
+        # 0, or constants.FAILURE if any command in the script failed
+        self.exit_code = exit_code
+        # everything the shell put() while running the script
+        self.output = output
+        # the number of seconds the script took, including shell startup
+        self.elapsed = elapsed
+        # the traceback, if the shell itself raised
+        self.error = error
+
+    def ok(self):
+        return self.exit_code == 0
+
+    def __repr__(self):
+        return "<ScriptResult %s exit=%d %.3fs>" % (self.script, self.exit_code, self.elapsed)
+
+
+def _run_script(task):
+    """
+    Run one script in a new headless shell. Called in the worker processes
+    """
+    factory, script, echo, stop_on_error = task
+    output = StringIO()
+    start = time.time()
+    error = None
+    shell = None
+    interrupts = signal.getsignal(signal.SIGINT)
+    try:
+        try:
+            shell = factory(renderer=NullRenderer())
+            # a headless shell has no terminal to restore on ^C, so leave
+            # interrupts to whoever is running the scripts rather than let
+            # the shell's handler end just this one
+            if interrupts is not None:
+                signal.signal(signal.SIGINT, interrupts)
+            exit_code = shell.run_batch(script, output=output, echo=echo,
+                                        stop_on_error=stop_on_error)
+        finally:
+            if shell is not None:
+                shell.end()
+    # a command calling sys.exit() would otherwise kill the pool worker and
+    # leave pool.map() waiting for its result forever
+    except (Exception, SystemExit):
+        exit_code = constants.FAILURE
+        error = traceback.format_exc()
+    return ScriptResult(script, exit_code, output.getvalue(),
+                        time.time() - start, error)
+
+
+def _ignore_interrupts():
+    """
+    Leave ^C to the parent process. Called in each new worker process
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_scripts(factory, scripts, processes=None, echo=False, stop_on_error=False):
+    """
+    Run independent script files in parallel, each in its own headless shell,
+    and return a ScriptResult for each, in the order of scripts.
+
+    Each script runs in a fresh shell, built by calling
+    factory(renderer=NullRenderer()) in a pool of worker processes, so no
+    terminal is touched and the work spreads across cores. factory is usually
+    the Shell subclass itself, and must be importable by the workers: define
+    it at module level, not inside a function. ^C abandons the scripts not
+    finished yet and raises KeyboardInterrupt. For example:
+
+    results = run_scripts(MyShell, glob.glob("bundles/*.txt"))
+    print(format_report(results))
+    sys.exit(max(r.exit_code for r in results))
+
+    Args:
+    factory         - Called with a renderer keyword argument to build a Shell
+    scripts         - The names of the script files to run
+
+    Kwargs:
+    processes       - The number of worker processes. Defaults to the number
+                      of CPUs. With 1, scripts run in this process
+    echo            - Whether to include each command in the output
+    stop_on_error   - Whether a script stops at its first failed command
+
+    Return:
+    The list of ScriptResults
+    """
+    tasks = [(factory, script, echo, stop_on_error) for script in scripts]
+    if processes == 1 or len(tasks) <= 1:
+        return [_run_script(task) for task in tasks]
+    pool = multiprocessing.Pool(processes, _ignore_interrupts)
+    try:
+        # waiting with a timeout lets ^C interrupt the wait on python 2
+        results = pool.map_async(_run_script, tasks, chunksize=1).get(_WAIT_FOREVER)
+    except BaseException:
+        # scripts still queued or running are abandoned
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+    return results
+
+
+def format_report(results, output=True):
+    """
+    Return a human-readable report of the results of run_scripts()
+
+    Args:
+    results - The list of ScriptResults
+
+    Kwargs:
+    output  - Whether to include the output of each script
+    """
+    lines = []
+    for result in results:
+        status = "ok" if result.ok() else "FAILED"
+        lines.append("== %s: %s in %.2fs" % (result.script, status, result.elapsed))
+        if output and result.output:
+            lines.append(result.output.rstrip('\n'))
+        if result.error:
+            lines.append(result.error.rstrip('\n'))
+    failed = len([r for r in results if not r.ok()])
+    lines.append("%d scripts, %d failed, %.2fs total" % (
+        len(results), failed, sum(r.elapsed for r in results)))
+    return "\n".join(lines)
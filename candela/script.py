@@ -0,0 +1,102 @@
+"""
+This file is part of Candela.
+
+Candela is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Candela is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Candela.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import stat
+import sys
+
+
+class ScriptReader(object):
+    """
+    Iterates over the lines of a Candela script without loading it into
+    memory.
+
+    Lines are read one at a time from a file, a pipe or stdin, and are
+    returned without their line endings. The number of bytes read so far is
+    kept in bytes_read, so progress can be shown for scripts of any size.
+    """
+    def __init__(self, source, encoding='utf-8'):
+        """
+        Open a script. Raises IOError or OSError if it can't be opened
+
+        Args:
+        source      - The name of the script file, '-' for stdin, or an open
+                      file object
+
+        Kwargs:
+        encoding    - The encoding used to decode lines on Python 3
+        """
+        self.encoding = encoding
+        if source == '-':
+            self.name = '<stdin>'
+            self._file = getattr(sys.stdin, 'buffer', sys.stdin)
+            self._owned = False
+        elif hasattr(source, 'readline'):
+            self.name = getattr(source, 'name', repr(source))
+            self._file = getattr(source, 'buffer', source)
+            self._owned = False
+        else:
+            self.name = source
+            self._file = open(source, 'rb')
+            self._owned = True
+
+        self.bytes_read = 0
+        self.lines_read = 0
+        # the size of the script in bytes, or None for pipes and terminals
+        self.size = None
+        try:
+            info = os.fstat(self._file.fileno())
+            if stat.S_ISREG(info.st_mode):
+                self.size = info.st_size
+        except (AttributeError, ValueError, OSError):
+            pass
+
+    def progress(self):
+        """
+        Return the fraction of the script read so far, between 0 and 1, or
+        None if the size of the script isn't known
+        """
+        if self.size is None:
+            return None
+        if self.size == 0:
+            return 1.0
+        return min(1.0, float(self.bytes_read) / self.size)
+
+    def close(self):
+        """
+        Close the script file, unless it was passed in already open
+        """
+        if self._owned and not self._file.closed:
+            self._file.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Return the next line. Raises IOError or OSError if reading fails
+        """
+        line = self._file.readline()
+        if not line:
+            self.close()
+            raise StopIteration
+        self.bytes_read += len(line)
+        self.lines_read += 1
+        if not isinstance(line, str):
+            line = line.decode(self.encoding, 'replace')
+        return line.rstrip('\r\n')
+
+    next = __next__
@@ -0,0 +1,160 @@
+"""
+This file is part of Candela.
+
+Candela is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Candela is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Candela.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from collections import deque
+
+from candela.layout import WrapCache
+
+
+class Scrollback(deque):
+    """
+    The shell's output history, stored as logical lines.
+
+    Each entry is a (text, command) tuple holding one line of output as it
+    was printed, before wrapping. Lines are only split into rows when they
+    are displayed, at the window width of the moment, so a resize reflows
+    the whole history without touching it. Only the rows that are visible
+    are ever computed.
+
+    Like a deque with maxlen, the oldest lines fall off the front once the
+    capacity is reached.
+
+    A row is identified by a position: a (line number, row) tuple, where the
+    line number counts every line ever appended, so it keeps pointing at the
+    same line as old ones fall off, and row is the index of the row within
+    the wrapped line. Moving a position visits only the lines it passes
+    over, however long the history is.
+    """
+    def __init__(self, capacity, wrap_cache=None):
+        """
+        Args:
+        capacity    - The maximum number of logical lines kept
+
+        Kwargs:
+        wrap_cache  - The WrapCache used to lay out lines
+        """
+        deque.__init__(self, (), capacity)
+        self.wrap_cache = wrap_cache or WrapCache()
+        # the number of lines ever appended
+        self.appended = 0
+
+    def append(self, line):
+        deque.append(self, line)
+        self.appended += 1
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    @property
+    def first(self):
+        """
+        The line number of the oldest line kept
+        """
+        return self.appended - len(self)
+
+    def _layout(self, number, width):
+        return self.wrap_cache.wrap(self[number - self.first][0], width)
+
+    def bottom(self, width):
+        """
+        Return the position of the newest row, or None if there are no lines
+
+        Args:
+        width   - The number of columns a row may take up
+        """
+        if not self:
+            return None
+        return (self.appended - 1, len(self._layout(self.appended - 1, width)) - 1)
+
+    def clamp(self, pos, width):
+        """
+        Return the position of the row nearest to pos that is still kept
+
+        Args:
+        pos     - A (line number, row) tuple
+        width   - The number of columns a row may take up
+        """
+        number, row = pos
+        if number < self.first:
+            return (self.first, 0)
+        if number >= self.appended:
+            return self.bottom(width)
+        return (number, max(0, min(row, len(self._layout(number, width)) - 1)))
+
+    def move(self, pos, width, count):
+        """
+        Return the position count rows older than pos, or newer if count is
+        negative, stopping at the oldest and newest rows
+
+        Args:
+        pos     - A (line number, row) tuple
+        width   - The number of columns a row may take up
+        count   - The number of rows to move by
+        """
+        number, row = self.clamp(pos, width)
+        while count > 0:
+            if row >= count:
+                return (number, row - count)
+            if number == self.first:
+                return (number, 0)
+            count -= row + 1
+            number -= 1
+            row = len(self._layout(number, width)) - 1
+        while count < 0:
+            below = len(self._layout(number, width)) - 1 - row
+            if below >= -count or number == self.appended - 1:
+                return (number, row + min(below, -count))
+            count += below + 1
+            number += 1
+            row = 0
+        return (number, row)
+
+    def rows(self, width, count, pos=None):
+        """
+        Return up to count rows, newest first, as (row text, command) tuples
+
+        Args:
+        width   - The number of columns a row may take up
+        count   - The number of rows wanted
+
+        Kwargs:
+        pos     - The position of the first row returned. Defaults to the
+                  newest row
+        """
+        output = []
+        if count <= 0 or not self:
+            return output
+        if pos is None:
+            wrap = self.wrap_cache.wrap
+            for text, command in reversed(self):
+                for row in reversed(wrap(text, width)):
+                    output.append((row, command))
+                    if len(output) == count:
+                        return output
+            return output
+        number, row = self.clamp(pos, width)
+        while True:
+            text, command = self[number - self.first]
+            layout = self.wrap_cache.wrap(text, width)
+            for i in range(row, -1, -1):
+                output.append((layout[i], command))
+                if len(output) == count:
+                    return output
+            if number == self.first:
+                return output
+            number -= 1
+            row = len(self._layout(number, width)) - 1
@@ -18,48 +18,372 @@ import curses
 import sys
 import signal
 import threading
-import textwrap
 import platform
+import time
+import contextlib
+import os.path
+from collections import deque, OrderedDict
+
+from candela import constants
+from candela.menu import ObservedList
+from candela.completion import CompletionCache, HookRunner
+from candela.jobs import Scheduler, FAILED, CANCELLED
+from candela.script import ScriptReader
+from candela.layout import WrapCache
+from candela.scrollback import Scrollback
+from candela.history import History, HistorySearch
+
+
+class CursesRenderer(object):
+    """
+    Draws the shell on the current terminal window using curses.
 
-import constants
+    A renderer is the only part of a Shell that touches the screen. It exposes
+    the small subset of the curses window API that the shell needs.
+    """
+    def __init__(self):
+        self.stdscr = None
 
+    def start(self):
+        """
+        Take over the current terminal by calling curses.initscr()
+        """
+        # report a lone Esc quickly rather than waiting a second to see
+        # whether it starts an escape sequence
+        os.environ.setdefault('ESCDELAY', '25')
+        self.stdscr = curses.initscr()
+        self.stdscr.keypad(1)
+        # the shell draws typed keys itself
+        curses.noecho()
+        # let curses use the terminal's insert/delete line capabilities
+        # when the backbuffer scrolls
+        self.stdscr.idlok(1)
 
-class Shell():
+    def end(self):
+        """
+        Safely shut down the curses session
+        """
+        curses.endwin()
+
+    def getmaxyx(self):
+        return self.stdscr.getmaxyx()
+
+    def getyx(self):
+        return self.stdscr.getyx()
+
+    def move(self, ypos, xpos):
+        try:
+            self.stdscr.move(ypos, xpos)
+        except curses.error:
+            # the terminal shrank beneath us
+            pass
+
+    def addstr(self, ypos, xpos, text):
+        try:
+            self.stdscr.addstr(ypos, xpos, text)
+        except curses.error:
+            pass
+
+    def erase(self):
+        self.stdscr.erase()
+
+    def clear(self):
+        """
+        Blank the screen, and repaint the whole terminal on the next refresh
+        """
+        self.stdscr.clear()
+
+    def getch(self):
+        return self.stdscr.getch()
+
+    def poll_key(self):
+        """
+        Return the next key if one is waiting, otherwise -1
+        """
+        self.stdscr.nodelay(True)
+        try:
+            return self.stdscr.getch()
+        finally:
+            self.stdscr.nodelay(False)
+
+    def timeout(self, delay):
+        """
+        Make getch() return -1 after waiting delay milliseconds for a key.
+        A negative delay waits forever
+        """
+        self.stdscr.timeout(delay)
+
+    def nodelay(self, flag):
+        """
+        If flag is True, make getch() return -1 instead of waiting for a key
+        """
+        self.stdscr.nodelay(flag)
+
+    def fileno(self):
+        """
+        Return the file descriptor keys are read from
+        """
+        return sys.stdin.fileno()
+
+    def update_size(self):
+        """
+        Resize the curses screen to fit the terminal. Only needed when
+        SIGWINCH is handled by something other than curses, like the asyncio
+        main loop, since curses then never learns of the new size
+        """
+        size = os.get_terminal_size(sys.stdout.fileno())
+        curses.resizeterm(size.lines, size.columns)
+
+    def refresh(self):
+        """
+        Push everything written since the last refresh to the terminal
+        in a single update
+        """
+        self.stdscr.noutrefresh()
+        curses.doupdate()
+
+
+class NullRenderer(object):
+    """
+    A renderer that draws nothing and leaves the terminal alone, for shells
+    that only run scripts with Shell.run_batch(). getch() raises EOFError.
+    """
+    def __init__(self, height=24, width=80):
+        self.height = height
+        self.width = width
+
+    def start(self):
+        pass
+
+    def end(self):
+        pass
+
+    def getmaxyx(self):
+        return (self.height, self.width)
+
+    def getyx(self):
+        return (0, 0)
+
+    def move(self, y, x):
+        pass
+
+    def addstr(self, y, x, text):
+        pass
+
+    def erase(self):
+        pass
+
+    def clear(self):
+        pass
+
+    def getch(self):
+        raise EOFError("NullRenderer has no input")
+
+    def poll_key(self):
+        return -1
+
+    def timeout(self, delay):
+        pass
+
+    def nodelay(self, flag):
+        pass
+
+    def fileno(self):
+        return None
+
+    def refresh(self):
+        pass
+
+
+class VirtualRenderer(object):
+    """
+    Draws the shell into an in-memory grid of cells instead of a terminal.
+
+    This allows a Shell to run without a tty: in CI, from cron, or under a
+    profiler. Nothing is ever written to a real terminal, so output is
+    recorded as fast as the shell can produce it.
+
+    Keystrokes for the shell to read are queued with feed(). When they run
+    out, getch() raises EOFError, which ends main_loop(). For example:
+
+    renderer = VirtualRenderer(50, 160)
+    renderer.feed("first_command\n")
+    MyShell(renderer=renderer).main_loop()
+    print "\n".join(renderer.display())
+    """
+    def __init__(self, height=24, width=80):
+        self.height = height
+        self.width = width
+        self.cells = [[" "]*width for i in range(height)]
+        self.cursor = (0, 0)
+        self.keys = deque()
+        # counters for benchmarking
+        self.cells_written = 0
+        self.refreshes = 0
+
+    def start(self):
+        pass
+
+    def end(self):
+        pass
+
+    def feed(self, keys):
+        """
+        Queue keystrokes to be returned by getch()
+
+        Args:
+        keys    - A string, each character of which is one keystroke, or a
+                  list of integer key codes like curses.KEY_UP
+        """
+        for key in keys:
+            if not isinstance(key, int):
+                key = ord(key)
+            self.keys.append(key)
+
+    def display(self):
+        """
+        Return the contents of the screen as a list of strings, one per row
+        """
+        return ["".join(row) for row in self.cells]
+
+    def resize(self, height, width):
+        """
+        Change the size of the screen, clearing it, and queue the
+        curses.KEY_RESIZE key a terminal would send
+
+        Args:
+        height  - The new number of rows
+        width   - The new number of columns
+        """
+        self.height = height
+        self.width = width
+        self.cells = [[" "]*width for i in range(height)]
+        self.keys.append(curses.KEY_RESIZE)
+
+    def getmaxyx(self):
+        return (self.height, self.width)
+
+    def getyx(self):
+        return self.cursor
+
+    def move(self, ypos, xpos):
+        self.cursor = (min(ypos, self.height-1), min(xpos, self.width-1))
+
+    def addstr(self, ypos, xpos, text):
+        if ypos < 0 or ypos >= self.height:
+            return
+        text = text[:self.width-xpos]
+        self.cells[ypos][xpos:xpos+len(text)] = list(text)
+        self.cells_written += len(text)
+        self.move(ypos, xpos+len(text))
+
+    def erase(self):
+        self.cells = [[" "]*self.width for i in range(self.height)]
+
+    def clear(self):
+        self.erase()
+
+    def getch(self):
+        if not self.keys:
+            raise EOFError("No more input queued for the virtual screen")
+        return self.keys.popleft()
+
+    def poll_key(self):
+        """
+        Return the next queued key, or -1 if there are none
+        """
+        if not self.keys:
+            return -1
+        return self.keys.popleft()
+
+    def timeout(self, delay):
+        pass
+
+    def nodelay(self, flag):
+        pass
+
+    def fileno(self):
+        """
+        Return None, since keys come from memory rather than a file
+        """
+        return None
+
+    def refresh(self):
+        self.refreshes += 1
+
+
+class Shell(object):
     """
     The main Candela class
     Controls the shell by taking control of the current terminal window.
     Performs input and output to the user
     """
-    def __init__(self, scriptfile=None):
+    def __init__(self, scriptfile=None, scrollback=200, renderer=None):
         """
         Create an instance of a Shell
-        This call takes over the current terminal by calling curses.initscr()
+        This call takes over the current terminal by starting the renderer,
+        which by default calls curses.initscr()
         Sets global shell state, including size information, menus, stickers,
         the header, and the prompt.
 
         Kwargs:
-        scriptfile - the name of the script file to run. If not None and the
-                     file exists, the script will be immediately run.
+        scriptfile - the name of the script file to run, or '-' for stdin.
+                     If not None, the script will be immediately run.
+        scrollback - the maximum number of lines of output kept in the
+                     backbuffer, counted before wrapping
+        renderer   - the object that draws the shell. If None, the result of
+                     create_renderer() is used
         """
         self._register_sigint_handler()
 
-        self.script_lines = self._parse_script_file(scriptfile)
-        self.script_counter = 0
+        # the ScriptReader for the script being run, if any, and the last
+        # error that stopped a script
+        self.script = None
         self.scriptfile = ""
+        self.script_error = None
+        # the stream put() writes to in batch mode, and the lines not yet
+        # written to it
+        self._output = None
+        self._output_lines = []
 
-        self.stdscr = curses.initscr()
-        self.stdscr.keypad(1)
+        self.renderer = renderer or self.create_renderer()
+        self.renderer.start()
 
         self.platform = self._get_platform()
 
-        # holds the backlog of shell output
-        self.backbuffer = []
-        self.height,self.width = self.stdscr.getmaxyx()
-
+        # the wrapped rows of recently displayed long lines
+        self.wrap_cache = WrapCache()
+        # holds the backlog of shell output as printed, unwrapped. the oldest
+        # lines fall off the front once it reaches capacity
+        self.backbuffer = Scrollback(scrollback, self.wrap_cache)
+        self.height,self.width = self.renderer.getmaxyx()
+        # when the window was resized, the size is read again once it has
+        # stayed unchanged for resize_delay seconds. until then the time to
+        # do so is kept in _resize_at
+        self.resize_delay = .05
+        self._resize_at = None
+        # the backbuffer position of the bottom row of output on screen while
+        # the user has scrolled back, or None to follow the newest output
+        self._scroll_pos = None
+
+        # maps each menu name to its Menu
+        self._menu_index = {}
         # the list of menus in the shell app
         self.menus = []
-        # the currently visible stickers in the app
-        self.stickers = []
+        # the currently visible stickers in the app: [text, pos] lists by
+        # sticker id, in the order they are drawn. stickers created without
+        # an id are found by their text through _sticker_ids. how many
+        # stickers are on each row is kept to place new ones below them
+        self._stickers = OrderedDict()
+        self._sticker_ids = {}
+        self._sticker_rows = {}
+        self._sticker_bottom = 2
+        # if set, stickers are repainted at most this many times per second.
+        # changes in between are drawn together with the next repaint
+        self.sticker_rate = None
+        self._last_sticker_paint = 0
+        # the rows with sticker changes waiting to be drawn
+        self._sticker_damage = set()
 
         # should the command menu be shown
         self.should_show_help = True
@@ -67,6 +391,44 @@ class Shell():
         # name of the next argument as the user types
         self.should_show_hint = False
 
+        # earlier results of tabcomplete hooks, and the thread that runs
+        # hooks with a timeout. set completion_cache to None to disable caching
+        self.completion_cache = CompletionCache()
+        self.completion_runner = HookRunner()
+        # set to a FuzzyMatcher to complete names typed with letters missing,
+        # rather than only names starting with what was typed
+        self.completion_matcher = None
+
+        # the thread allowed to touch the screen and the shell's state.
+        # output from other threads is queued for it
+        self._ui_thread = threading.current_thread()
+        # functions queued from other threads to be called on the UI thread,
+        # the function that wakes the UI thread up to call them, and when
+        # another thread last queued one
+        self._ui_queue = deque()
+        self._ui_wakeup = None
+        self._threaded_output_at = None
+        # the thread pool running jobs started by submit() and defer()
+        self.jobs = Scheduler(max_workers=4, deliver=self.call_soon,
+                              on_change=self._job_changed)
+        # the text of the status sticker shown for each job, by job id
+        self._job_stickers = {}
+        # how often, in seconds, the input line checks for finished jobs,
+        # and for how long after another thread last queued output it keeps
+        # checking for more
+        self.poll_interval = .1
+        self.threaded_output_window = 60
+
+        # the most times per second the screen is redrawn while a command
+        # streams output, and the key that stops the stream
+        self.stream_refresh_rate = 20
+        self.interrupt_key = 27  # esc
+        # bumped whenever the interrupt key is pressed
+        self._interrupts = 0
+        # keys read while a command was streaming output, to be handled by
+        # the next input line
+        self._typeahead = deque()
+
         # dictionary of functions to call on key events
         # keys are chars representing the pressed keys
         self.keyevent_hooks = {}
@@ -76,43 +438,152 @@ class Shell():
         self._header_bottom = 0
         self._header_right = 0
         self._header_right_margin = 50
+        # the header and help box as padded rows ready to draw, and what
+        # they were built from
+        self._header_rows = None
+        self._header_source = None
+        self._help_rows = None
+        self._help_source = None
+        self._help_longest = 0
 
         self.prompt = "> "
 
-    def _parse_script_file(self, filename):
+        # the rows last written to the terminal. _update_screen() compares
+        # the newly composed canvas against this to find damaged cells
+        self._frame = []
+        # the rows being composed for the next frame, and the rows of the
+        # last frame before the stickers and input line were drawn on top
+        self._canvas = []
+        self._base = []
+        # the text currently shown on the input line
+        self._inputline = ""
+        # the line being edited and the cursor position within it
+        self._buff = ""
+        self._cursor = 0
+        # the commands entered so far, for the up and down arrows. replace it
+        # with History(path) to keep them in a file across sessions
+        self.history = History()
+        # the Ctrl-R search through the history in progress, if any
+        self._search = None
+
+        # how many batch() blocks are currently open, and whether a screen
+        # update was requested inside them
+        self._batch_depth = 0
+        self._batch_pending = False
+
+        # if set, the screen is redrawn at most this many times per second.
+        # updates in between only mark it dirty, and are drawn together
+        self.max_fps = None
+        self._dirty = False
+        self._last_frame = 0
+        # called with a delay in seconds when a held back frame should be
+        # drawn later, by event loops that can schedule it
+        self._render_wakeup = None
+        # how many frames were drawn, and how many updates were merged into
+        # a later frame instead of being drawn
+        self.frames_rendered = 0
+        self.frames_coalesced = 0
+
+        if scriptfile is not None:
+            self.runscript(scriptfile)
+
+    def create_renderer(self):
         """
-        Open a file if it exists and return its contents as a list of lines
+        Return the renderer to use when none is passed to __init__()
 
-        Args:
-        filename - the file to attempt to open
+        Subclasses can override this to run headless, like so:
+
+        def create_renderer(self):
+            return VirtualRenderer(50, 160)
         """
-        self.scriptfile = filename
-        try:
-            f = open(filename, 'r')
-            script_lines = f.readlines()
-            script_lines = [a.strip('\n') for a in script_lines]
-            f.close()
-        except Exception as e:
-            return
-        return script_lines
+        return CursesRenderer()
 
     def runscript(self, scriptfile):
         """
         Set up the global shell state necessary to run a script from a file
 
+        The script is read one line at a time as it runs, so it can be of any
+        size, or come from a pipe. If it can't be opened, the error is shown
+        in the shell. How far the script has come is available from
+        self.script.progress().
+
         Args:
         scriptfile - the string name of the file containing the script.
-                     paths are relative to system cwd
+                     paths are relative to system cwd. '-' reads the script
+                     from stdin
+        """
+        if self.script is not None:
+            self.script.close()
+        self.script = None
+        self.scriptfile = scriptfile
+        self.script_error = None
+        try:
+            self.script = ScriptReader(scriptfile)
+        except (IOError, OSError) as e:
+            self.script_error = e
+            self.put("Could not open script '%s': %s" % (scriptfile, e.strerror or e))
+
+    @property
+    def menus(self):
+        """
+        The list of Menu objects in the shell app.
+        It can be assigned to or modified in place.
+        """
+        return self._menus
+
+    @menus.setter
+    def menus(self, menus):
+        self._menus = ObservedList(self._reindex_menus, menus, self._add_menus)
+        self._reindex_menus()
+
+    @property
+    def stickers(self):
+        """
+        The list of (text, (y, x)) tuples of the visible stickers, in the
+        order they are drawn. Assigning to it replaces every sticker
+        """
+        return [(text, pos) for text, pos in self._stickers.values()]
+
+    @stickers.setter
+    def stickers(self, stickers):
+        self._stickers.clear()
+        self._sticker_ids.clear()
+        self._sticker_rows.clear()
+        self._sticker_bottom = 2
+        for text, pos in stickers:
+            self._add_sticker(object(), text, pos)
+
+    def _reindex_menus(self):
         """
-        self.script_lines = self._parse_script_file(scriptfile)
-        self.script_counter = 0
+        Rebuild the menu name index after the list of menus has changed
+        """
+        index = {}
+        for menu in self._menus:
+            index.setdefault(menu.name, menu)
+        self._menu_index = index
+
+    def _add_menus(self, menus, at_end):
+        """
+        Add newly added menus to the menu name index
+
+        Args:
+        menus   - The Menu objects added
+        at_end  - Whether they were added after every other menu
+        """
+        if not at_end:
+            self._reindex_menus()
+            return
+        for menu in menus:
+            self._menu_index.setdefault(menu.name, menu)
 
     def get_helpstring(self):
         """
         Get the help string for the current menu.
 
         This string contains a preformatted list of commands and their
-        descriptions from the current menu.
+        descriptions from the current menu. The help box on screen is only
+        laid out again when the current menu, its title, or its commands
+        change, so overrides should depend on nothing else.
         """
         _menu = self.get_menu()
         if not _menu:
@@ -121,7 +592,7 @@ class Shell():
         helpstring = "\n\n" + _menu.title + "\n" + "-"*20 + "\n" + _menu.options()
         return helpstring
 
-    def sticker(self, output, new_output="", pos=None):
+    def sticker(self, output, new_output="", pos=None, id=None):
         """
         Place, change, or remove a sticker from the shell window.
 
@@ -134,73 +605,158 @@ class Shell():
         sticker whose text is the same as output, this will replace that
         sticker's text with new_output.
 
+        Stickers that change often, like status counters, are better given an
+        id. The sticker with that id is created, or changed to show output,
+        without having to know its previous text:
+
+            self.sticker("%d files copied" % done, id="copy")
+
+        Changing, adding or removing a sticker only redraws the rows it is on,
+        rather than the whole screen. See also sticker_rate.
+
         Args:
         output      - The text of the sticker to manipulate
 
         Kwargs:
         new_output  - The text that will replace the text of the chosen sticker
         pos         - The (y, x) tuple indicating where to place the sticker
-        """
-        if len(self.stickers) > 0:
-            sort = sorted(self.stickers, key=lambda x: x[1][0], reverse=True)
-            ht = sort[0][1][0]+1
-        else:
-            ht = 3
-
-        pos = pos or (ht, self.width - 20)
-
-        match = None
-        for text,_pos in self.stickers:
-            if output == text:
-                match = (text,_pos)
-                break
-        if match:
-            self.remove_sticker(match[0])
+        id          - Any hashable value naming the sticker
 
-        sticker = (new_output or output, match[1] if match else pos)
-        self.stickers.append(sticker)
-
-        self._update_screen()
-
-    def remove_sticker(self, text):
+        Safe to call from any thread. From threads other than the UI thread,
+        the change is queued and made by the UI thread.
         """
-        Remove the sticker with the given text from the window
+        if not self._on_ui_thread():
+            self.call_soon(self.sticker, output, new_output, pos, id)
+            return
+        if id is None:
+            id = self._sticker_ids.get(output)
+            output = new_output or output
+        sticker = self._stickers.get(id)
+        if sticker is None:
+            pos = pos or (self._sticker_bottom + 1, self.width - 20)
+            self._add_sticker(object() if id is None else id, output, pos)
+            self._sticker_changed([pos[0]])
+            return
+        text, _pos = sticker
+        if self._sticker_ids.get(text) == id:
+            del self._sticker_ids[text]
+        self._sticker_ids[output] = id
+        sticker[0] = output
+        self._sticker_changed([_pos[0]])
+
+    def remove_sticker(self, text=None, id=None):
+        """
+        Remove the sticker with the given text or id from the window
 
-        Args:
+        Kwargs:
         text    - The text of the sticker to remove
+        id      - The id the sticker was created with
+        """
+        if not self._on_ui_thread():
+            self.call_soon(self.remove_sticker, text, id)
+            return
+        if id is None:
+            id = self._sticker_ids.get(text)
+        sticker = self._stickers.pop(id, None)
+        if sticker is None:
+            return
+        text, pos = sticker
+        if self._sticker_ids.get(text) == id:
+            del self._sticker_ids[text]
+        row = pos[0]
+        self._sticker_rows[row] -= 1
+        if not self._sticker_rows[row]:
+            del self._sticker_rows[row]
+            if row == self._sticker_bottom:
+                self._sticker_bottom = max(self._sticker_rows or [2])
+        self._sticker_changed([row])
+
+    def _add_sticker(self, id, text, pos):
         """
-        self.stickers = [a for a in self.stickers if a[0] != text]
+        Add a sticker to the store without drawing it
+        """
+        self._stickers[id] = [text, pos]
+        self._sticker_ids[text] = id
+        row = pos[0]
+        self._sticker_rows[row] = self._sticker_rows.get(row, 0) + 1
+        if len(self._stickers) == 1:
+            self._sticker_bottom = row
+        else:
+            self._sticker_bottom = max(self._sticker_bottom, row)
 
+    def _sticker_changed(self, rows):
+        """
+        Redraw the rows a sticker change touched, or the whole screen if
+        that is due anyway
 
-    def _print_stickers(self):
+        Args:
+        rows    - The rows the changed sticker is on
+        """
+        if (not self._frame or len(self._base) != self.height or self._dirty
+                or self._resize_at is not None or self._batch_depth
+                or self._output is not None):
+            self._update_screen()
+            return
+        self._sticker_damage.update(rows)
+        if self.sticker_rate:
+            wait = self._last_sticker_paint + 1.0 / self.sticker_rate - time.time()
+            if wait > 0:
+                if self._render_wakeup is not None:
+                    self._render_wakeup(wait)
+                return
+        self._paint_stickers()
+
+    def _paint_stickers(self):
+        """
+        Redraw the rows with sticker changes on top of the last frame, and
+        write only the cells that changed
+        """
+        self._last_sticker_paint = time.time()
+        rows = sorted(y for y in self._sticker_damage if 0 <= y < self.height)
+        self._sticker_damage.clear()
+        for ypos in rows:
+            self._canvas[ypos] = self._base[ypos]
+        self._print_stickers(rows)
+        if self.height-1 in rows:
+            self._print_inputline()
+        self._flush_canvas(rows)
+
+    def _print_stickers(self, rows=None):
         """
         Print all current stickers at the appropriate positions
+
+        Kwargs:
+        rows    - Only print the stickers on these rows
         """
-        for text,pos in self.stickers:
+        for text, pos in self._stickers.values():
             _y,_x = pos
+            if rows is not None and _y not in rows:
+                continue
             if _x + len(text) > self.width:
                 _x = self.width - len(text) - 1
-            self.stdscr.addstr(_y, _x, text)
+            self._draw(_y, _x, text)
 
     def _print_header(self):
         """
         Print the header in the appropriate position
         """
-        ht = 0
-        for line in self.header.split("\n"):
-            self.stdscr.addstr(ht, 0, line + (" "*self._header_right_margin))
-            if len(line) > self._header_right:
-                self._header_right = len(line)
-            ht += 1
-        self.stdscr.addstr(ht, 0, " "*(self._header_right+self._header_right_margin))
-        self._header_bottom = ht
-        self.mt_width = self._header_right + 49
+        if self._header_source != self.header:
+            self._header_source = self.header
+            self._header_rows = []
+            for line in self.header.split("\n"):
+                self._header_rows.append(line + (" "*self._header_right_margin))
+                if len(line) > self._header_right:
+                    self._header_right = len(line)
+            self._header_rows.append(" "*(self._header_right+self._header_right_margin))
+            self._header_bottom = len(self._header_rows) - 1
+            self.mt_width = self._header_right + 49
+        for ht, row in enumerate(self._header_rows):
+            self._draw(ht, 0, row)
 
     def clear(self):
         """
         Remove all scrollback text from the window
         """
-        backbuffer = list(self.backbuffer)
         printstring = "\n"
         for i in range(self.height):
             self.put(printstring)
@@ -212,35 +768,103 @@ class Shell():
         candela.shell.Shell stores previously printed commands and output
         in a backbuffer. Like a normal shell, it handles printing these lines
         in reverse order to allow the user to see their past work.
+        Lines are wrapped for the current width here, and only the lines
+        that fit on the screen are visited.
         """
-        rev = list(self.backbuffer)
-        rev.reverse()
-
-        for i, tup in zip(range(len(rev)), rev):
+        self._scroll_pos = pos = self._clamp_scroll(self._scroll_pos)
+        visible = self.backbuffer.rows(self.width-3, self.height-2, pos)
+        for i, tup in enumerate(visible):
             string, iscommand = tup
             ypos = self.height-2-i
-            if ypos > 0:
-                printstring = string
-                if iscommand:
-                    printstring = "%s%s" % (self.prompt, string)
-                self.stdscr.addstr(ypos,0,printstring)
+            printstring = string
+            if iscommand:
+                printstring = "%s%s" % (self.prompt, string)
+            self._draw(ypos, 0, printstring)
+        if pos is not None:
+            # show which lines are on screen while scrolled back
+            first = self.backbuffer.first
+            top = self.backbuffer.move(pos, self.width-3, len(visible)-1)
+            indicator = " lines %d-%d of %d " % (top[0]-first+1, pos[0]-first+1,
+                                                 len(self.backbuffer))
+            self._draw(self.height-2, self.width-1-len(indicator), indicator)
+
+    def scroll(self, count):
+        """
+        Scroll the output up by count rows, or down if count is negative.
+        Scrolling down to the newest row follows new output again.
+
+        Only the rows scrolled over and the rows on screen are wrapped, so
+        this takes the same time however long the backbuffer is.
+
+        Args:
+        count   - The number of rows to scroll by
+        """
+        pos = self._scroll_pos or self.backbuffer.bottom(self.width-3)
+        if pos is None:
+            return
+        pos = self.backbuffer.move(pos, self.width-3, count)
+        self._scroll_pos = self._clamp_scroll(pos)
+        self._update_screen()
+
+    def scroll_to_top(self):
+        """
+        Scroll the output back to the oldest line in the backbuffer
+        """
+        if self.backbuffer:
+            self._scroll_pos = self._clamp_scroll((self.backbuffer.first, 0))
+            self._update_screen()
+
+    def scroll_to_bottom(self):
+        """
+        Scroll the output down to the newest line, and follow new output
+        """
+        if self._scroll_pos is not None:
+            self._scroll_pos = None
+            self._update_screen()
+
+    def _clamp_scroll(self, pos):
+        """
+        Return the scroll position nearest to pos that fills the screen with
+        output, or None if that is the newest row
+
+        Args:
+        pos     - A backbuffer position, or None
+        """
+        if pos is None or not self.backbuffer:
+            return None
+        width = self.width-3
+        # the output can be scrolled until the oldest row reaches the top
+        top = self.backbuffer.move((self.backbuffer.first, 0), width,
+                                   3-self.height)
+        pos = max(self.backbuffer.clamp(pos, width), top)
+        if pos >= self.backbuffer.bottom(width):
+            return None
+        return pos
 
     def _print_help(self):
         """
         Print the menu help box for the current menu
+
+        The box is only laid out again when the current menu, its title, or
+        its commands change.
         """
-        _helpstring = self.get_helpstring()
-        if not _helpstring:
+        menu = self.get_menu()
+        source = (menu, menu.version, menu.title) if menu else None
+        if source != self._help_source:
+            self._help_source = source
+            self._help_rows = []
+            _helpstring = self.get_helpstring()
+            if _helpstring:
+                helpstrings = [" %s" % a for a in _helpstring.split("\n")]
+                self._help_longest = len(max(helpstrings, key=len))
+                self._help_rows = [line + " "*15 for line in helpstrings]
+        if not self._help_rows:
             return
-        helpstrings = [" %s" % a for a in _helpstring.split("\n")]
-        ht = 0
-        longest = len(max(helpstrings, key=len))
         _x = self._header_right + self._header_right_margin
-        if _x + longest > self.width:
-            _x = self.width - longest - 1
-        for line in helpstrings:
-            self.stdscr.addstr(ht, _x, line + " "*15)
-            ht += 1
+        if _x + self._help_longest > self.width:
+            _x = self.width - self._help_longest - 1
+        for ht, line in enumerate(self._help_rows[:self.height]):
+            self._draw(ht, _x, line)
 
     def put(self, output, command=False):
         """
@@ -254,36 +878,92 @@ class Shell():
         Kwargs:
         command - False if the string was not a user-entered command,
                   True otherwise (users of Candela should always use False)
-        """
-        self._update_screen()
 
+        Safe to call from any thread. Output from threads other than the UI
+        thread is queued, and printed in order by the UI thread, many lines
+        per redraw.
+        """
+        if not self._on_ui_thread():
+            self.call_soon(self.put, output, command)
+            return
         if not output:
+            self._update_screen()
             return
+        self._add_output(output, command)
+        self._update_screen()
 
-        output = str(output)
+    def _add_output(self, output, command=False):
+        """
+        Add the lines of output to the backbuffer without redrawing the screen.
+        In batch mode, write them to the output stream instead
 
-        _x,_y = (self.height-1, 0)
+        Args:
+        output  - The string to print. May contain newlines
 
-        lines = []
-        for line in output.split('\n'):
-            if len(line) > self.width - 3:
-                for line in textwrap.wrap(line, self.width-3):
-                    lines.append(line)
-            else:
-                lines.append(line)
+        Kwargs:
+        command - Whether the string was a user-entered command
+        """
+        if self._output is not None:
+            if output:
+                self._write_output(output)
+            return
 
-        for line in lines:
-            # put the line
-            self.stdscr.addstr(_x, _y, line)
+        output = str(output)
 
+        for line in output.split('\n'):
             # add it to backbuffer
-            backbuf_string = line
-            to_append = (backbuf_string, command)
             if line != self.prompt:
-                index = 0
-                if len(self.backbuffer) >= 200:
-                    index = 1
-                self.backbuffer = self.backbuffer[index:] + [to_append]
+                self.backbuffer.append((line, command))
+
+    def put_many(self, outputs, command=False):
+        """
+        Print each string from an iterable as if by put(), redrawing the
+        screen once after the last one rather than once per string.
+
+        Args:
+        outputs - An iterable of strings to print. Each may contain newlines
+
+        Kwargs:
+        command - Passed through to put() for every string
+        """
+        if not self._on_ui_thread():
+            self.call_soon(self.put_many, list(outputs), command)
+            return
+        with self.batch():
+            for output in outputs:
+                self.put(output, command=command)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Defer screen updates until the end of a block of output.
+
+        Every put() and sticker() normally redraws the screen. Inside a batch
+        they only change the shell state, and the screen is redrawn once when
+        the outermost batch exits. This is useful in command callbacks that
+        print many lines, like so:
+
+        def _run(*args, **kwargs):
+            with self.batch():
+                for row in report:
+                    self.put(row)
+            return constants.CHOICE_VALID
+
+        Batches can be nested. The redraw happens even if the block raises.
+        On threads other than the UI thread, batch() does nothing, since their
+        output is already queued and printed together.
+        """
+        if not self._on_ui_thread():
+            yield self
+            return
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._batch_pending:
+                self._batch_pending = False
+                self._update_screen()
 
     def _input(self, prompt):
         """
@@ -297,77 +977,225 @@ class Shell():
         Args:
         prompt  - The text to display prompting the user to enter text
         """
-        self.put(prompt)
-        keyin = ''
-        buff = ''
-        hist_counter = 1
-        while keyin != 10:
-            keyin = self.stdscr.getch()
-            _y,_x = self.stdscr.getyx()
-            index = _x - len(self.prompt)
-            #self.stdscr.addstr(20, 70, str(keyin))  # for debugging
-            try:
-                if chr(keyin) in self.keyevent_hooks.keys():
-                    cont = self.keyevent_hooks[chr(keyin)](chr(keyin), buff)
-                    if cont == False:
-                        continue
-            except:
-                pass
-            if keyin in [127, 263]:  # backspaces
-                del_lo, del_hi = self._get_backspace_indices()
-                buff = buff[:index+del_lo] + buff[index+del_hi:]
-                self._redraw_buffer(buff)
-                self.stdscr.move(_y, max(_x+del_lo, len(self.prompt)))
-            elif keyin in [curses.KEY_UP, curses.KEY_DOWN]:  # up and down arrows
-                hist_counter,buff = self._process_history_command(keyin, hist_counter)
-            elif keyin in [curses.KEY_LEFT, curses.KEY_RIGHT]:  # left, right arrows
-                if keyin == curses.KEY_LEFT:
-                    newx = max(_x - 1, len(self.prompt))
-                elif keyin == curses.KEY_RIGHT:
-                    newx = min(_x + 1, len(buff) + len(self.prompt))
-                self.stdscr.move(_y, newx)
-            elif keyin == curses.KEY_F1:  # F1
-                curses.endwin()
-                sys.exit()
-            elif keyin in [9]:  # tab
-                choices = self._tabcomplete(buff)
-                if len(choices) == 1:
-                    if len(buff.split()) == 1 and not buff.endswith(' '):
-                        buff = choices[0]
-                    else:
-                        if len(buff.split()) != 1 and not buff.endswith(' '):
-                            buff = ' '.join(buff.split()[:-1])
-                        if buff.endswith(' '):
-                            buff += choices[0]
-                        else:
-                            buff += ' ' + choices[0]
-                elif len(choices) > 1:
-                    self.put("    ".join(choices))
-                elif len(choices) == 0:
-                    pass
-                self._redraw_buffer(buff)
-            elif keyin >= 32 and keyin <= 126:  # ascii input
-                buff = buff[:index-1] + chr(keyin) + buff[index-1:]
-                self._redraw_buffer(buff)
-                self.stdscr.move(_y, min(_x, len(buff) + len(self.prompt)))
-                if self.should_show_hint and keyin == 32:
-                    command = self._get_command(buff)
-                    if hasattr(command, 'definition') and '-' not in command.definition:
-                        try:
-                            nextarg = command.definition.split()[len(buff.split())]
-                            self.stdscr.addstr(_y, _x+1, nextarg)
-                            self.stdscr.move(_y, _x)
-                        except:
-                            pass
+        self._begin_input(prompt)
+        done = False
+        while not done:
+            self._drain_ui_queue()
+            if self._typeahead:
+                done = self._handle_key(self._typeahead.popleft())
+                continue
+            # draw a frame held back by max_fps while waiting for a key, and
+            # wake up now and then to deliver the results of running jobs
+            waits = [self._render_if_due()]
+            if self.jobs.busy() or self._ui_queue or self._threaded_output_recent():
+                waits.append(self.poll_interval)
+            waits = [w for w in waits if w is not None]
+            if waits:
+                self.renderer.timeout(max(1, int(min(waits) * 1000)))
+            else:
+                self.renderer.timeout(-1)
+            done = self._handle_key(self.renderer.getch())
+        return self._finish_input()
+
+    def _begin_input(self, prompt):
+        """
+        Show the prompt on the input line and reset the state of the line
+        being edited
+
+        Args:
+        prompt  - The text to display prompting the user to enter text
+        """
+        self._buff = ''
+        self._cursor = 0
+        self._search = None
+        self.history.reset()
+        self._inputline = prompt
+        self._update_screen()
+        self.renderer.move(self.height-1, len(prompt))
+
+    def _finish_input(self):
+        """
+        Clear the input line, move the entered command into the backbuffer
+        and return it
+        """
+        buff = self._buff
+        self._inputline = ""
+        # entering a command jumps back to the newest output
+        self._scroll_pos = None
+        self.history.append(buff)
         self.put(buff, command=True)
-        self.stdscr.refresh()
         return buff
 
-    def _get_backspace_indices(self):
-        if self.platform == "Linux":
-            return (0, 1)
-        elif self.platform == "Darwin":
-            return (-len(self.prompt)-1, -len(self.prompt))
+    def _handle_key(self, keyin, choices=None):
+        """
+        Apply a single keystroke to the line being edited.
+
+        The shell keeps track of the buffer and cursor position itself, so keys
+        can be handled one at a time from any source: the blocking loop in
+        _input(), or the event loop in main_loop_async().
+
+        Args:
+        keyin   - The integer key code, as returned by the renderer's getch()
+
+        Kwargs:
+        choices - The tab completions for the current buffer, if they have
+                  already been computed. Only used when keyin is Tab
+
+        Return:
+        True if the key finished the line of input, False otherwise
+        """
+        if keyin == -1:  # no key was available
+            return False
+        if keyin == curses.KEY_RESIZE:
+            # windows are resized in many small steps. lay out again once
+            # they stop
+            self._resize_at = time.time() + self.resize_delay
+            if self._render_wakeup is not None:
+                self._render_wakeup(self.resize_delay)
+            return False
+        # any hook still running for an earlier Tab is now out of date
+        self.completion_runner.cancel()
+        if self._search is not None:
+            return self._handle_search_key(keyin)
+        buff = self._buff
+        index = self._cursor
+        #self.renderer.addstr(20, 70, str(keyin))  # for debugging
+        try:
+            if chr(keyin) in self.keyevent_hooks.keys():
+                cont = self.keyevent_hooks[chr(keyin)](chr(keyin), buff)
+                if cont == False:
+                    return False
+        except:
+            pass
+        if keyin == self.interrupt_key:
+            self._interrupts += 1
+            return False
+        if keyin == 10:  # return
+            return True
+        if keyin in [127, 263]:  # backspaces
+            if index > 0:
+                buff = buff[:index-1] + buff[index:]
+                index -= 1
+        elif keyin in [curses.KEY_UP, curses.KEY_DOWN]:  # up and down arrows
+            buff = self._process_history_command(keyin, buff)
+            index = len(buff)
+        elif keyin == 18:  # ctrl-r
+            self._search = HistorySearch(self.history)
+            self._redraw_search()
+            return False
+        elif keyin == curses.KEY_PPAGE:  # page up
+            self.scroll(max(self.height-3, 1))
+        elif keyin == curses.KEY_NPAGE:  # page down
+            self.scroll(-max(self.height-3, 1))
+        elif keyin == curses.KEY_HOME:
+            self.scroll_to_top()
+        elif keyin == curses.KEY_END:
+            self.scroll_to_bottom()
+        elif keyin == curses.KEY_LEFT:
+            index = max(index - 1, 0)
+        elif keyin == curses.KEY_RIGHT:
+            index = min(index + 1, len(buff))
+        elif keyin == curses.KEY_F1:  # F1
+            self.end()
+            sys.exit()
+        elif keyin in [9]:  # tab
+            if choices is None:
+                choices = self._tabcomplete(buff)
+            if len(choices) == 1:
+                buff = self._complete_buffer(buff, choices[0])
+            elif len(choices) > 1:
+                # extend the current token as far as all choices agree. a
+                # fuzzy matcher only returns the best few matches, so what
+                # they share says nothing about the rest
+                if self.completion_matcher is None:
+                    prefix = os.path.commonprefix(choices)
+                    tokens = buff.split()
+                    frag = tokens[-1] if tokens and not buff.endswith(' ') else ''
+                    if len(prefix) > len(frag):
+                        buff = self._complete_buffer(buff, prefix)
+                self.put("    ".join(choices))
+            index = len(buff)
+        elif keyin >= 32 and keyin <= 126:  # ascii input
+            buff = buff[:index] + chr(keyin) + buff[index:]
+            index += 1
+
+        self._buff = buff
+        self._cursor = index
+        self._redraw_buffer(buff)
+        _y, _x = self.height-1, len(self.prompt) + index
+        self.renderer.move(_y, _x)
+        if self.should_show_hint and keyin == 32:
+            command = self._get_command(buff)
+            if hasattr(command, 'definition') and '-' not in command.definition:
+                try:
+                    nextarg = command.definition.split()[len(buff.split())]
+                    self._draw(_y, _x+1, nextarg)
+                    self._flush_canvas([_y])
+                    self.renderer.move(_y, _x)
+                except:
+                    pass
+        return False
+
+    def _handle_search_key(self, keyin):
+        """
+        Apply a keystroke to the Ctrl-R search in progress.
+
+        Typing and backspace change the search, and Ctrl-R moves on to the
+        next match. Esc and Ctrl-G cancel the search. Any other key puts the
+        match on the input line to be edited, and return runs it.
+
+        Args:
+        keyin   - The integer key code
+
+        Return:
+        True if the key finished the line of input, False otherwise
+        """
+        search = self._search
+        if keyin == 18:  # ctrl-r
+            search.next_match()
+        elif keyin in [127, 263]:  # backspaces
+            search.remove()
+        elif keyin >= 32 and keyin <= 126:
+            search.add(chr(keyin))
+        else:
+            self._search = None
+            if keyin not in [self.interrupt_key, 7] and search.match is not None:
+                self._buff = search.match
+                self._cursor = len(self._buff)
+            self._redraw_buffer(self._buff)
+            self.renderer.move(self.height-1, len(self.prompt) + self._cursor)
+            return keyin == 10
+        self._redraw_search()
+        return False
+
+    def _redraw_search(self):
+        """
+        Show the Ctrl-R search in progress on the input line
+        """
+        search = self._search
+        label = "reverse-i-search"
+        if search.query and search.match is None:
+            label = "failed " + label
+        self._redraw_inputline("(%s)`%s': %s" % (label, search.query, search.match or ""))
+
+    def _complete_buffer(self, buff, completion):
+        """
+        Return the buffer with its last token replaced by a completion
+
+        Args:
+        buff        - The string buffer representing the current command input
+        completion  - The text that completes the token being typed
+        """
+        tokens = buff.split()
+        if not tokens:
+            return completion
+        if len(tokens) == 1 and not buff.endswith(' '):
+            return completion
+        if not buff.endswith(' '):
+            buff = ' '.join(tokens[:-1])
+        if buff.endswith(' '):
+            return buff + completion
+        return buff + ' ' + completion
 
     def _tabcomplete(self, buff):
         """
@@ -381,24 +1209,21 @@ class Shell():
         buff    - The string buffer representing the current unfinished command input
 
         Return:
-        A list of completion strings for the current token in the command
+        A list of completion strings for the current token in the command.
+        Command name completions are sorted and contain no duplicates. With a
+        completion_matcher, completions are ranked best first instead.
         """
         menu = self.get_menu()
-        commands = []
-        if menu:
-            commands = menu.commands
         output = []
         if len(buff.split()) <= 1 and ' ' not in buff:
-            for command in commands:
-                if command.name.startswith(buff):
-                    output.append(command.name)
-                for alias in command.aliases:
-                    if alias.startswith(buff):
-                        output.append(alias)
+            if menu:
+                output = menu.complete(buff, matcher=self.completion_matcher)
         else:
             command = self._get_command(buff)
             if command:
-                output = command._tabcomplete(buff)
+                output = command._tabcomplete(buff, cache=self.completion_cache,
+                                              runner=self.completion_runner,
+                                              matcher=self.completion_matcher)
         return output
 
     def _get_command(self, buff):
@@ -412,65 +1237,79 @@ class Shell():
         The Command instance corresponding to the buffer command
         """
         menu = self.get_menu()
-        commands = []
-        if menu:
-            commands = menu.commands
-        if len(commands) == 0:
+        if not menu or not menu.commands:
             self.put("No commands found. Maybe you forgot to set self.menus or self.menu?")
             self.put("Hint: use F1 to quit")
-        for command in commands:
-            if command.name == buff.split()[0] or buff.split()[0] in command.aliases:
-                return command
-        return None
+            return None
+        tokens = buff.split()
+        if not tokens:
+            return None
+        return menu.get_command(tokens[0])
 
     def _redraw_buffer(self, buff):
         """
         Clear the bottom line and re-print the given string on that line
 
+        Only the cells that differ from what is already on the terminal are
+        written. The cursor is left at the end of the line.
+
         Args:
         buff    - The line to print on the cleared bottom line
         """
-        self.stdscr.addstr(self.height-1, 0, " "*(self.width-3))
-        self.stdscr.addstr(self.height-1, 0, "%s%s" % (self.prompt, buff))
+        self._redraw_inputline("%s%s" % (self.prompt, buff))
 
-    def _process_history_command(self, keyin, hist_counter):
+    def _redraw_inputline(self, line):
         """
-        Get the next command from the backbuffer and return it
-        Also return the modified buffer counter.
+        Replace the text on the input line, leaving the cursor at its end
 
         Args:
-        keyin           - The key just pressed
-        hist_counter    - The current position in the backbuffer
+        line    - The new contents of the input line
         """
-        hist_commands = [(s,c) for s,c in self.backbuffer if c]
-        if not hist_commands:
-            return hist_counter, ""
-
-        buff = hist_commands[-hist_counter][0]
-
-        self.stdscr.addstr(self.height-1, 0, " "*(self.width-3))
-        self.stdscr.addstr(self.height-1, 0, "%s%s" % (self.prompt, buff))
+        self._inputline = line
+        ypos = self.height-1
+        if ypos < len(self._canvas):
+            self._canvas[ypos] = " "*len(self._canvas[ypos])
+            self._print_inputline()
+            self._flush_canvas([ypos])
+        self.renderer.move(ypos, min(len(self._inputline), self.width-1))
+
+    def _process_history_command(self, keyin, buff):
+        """
+        Move through the command history and return the command to edit
 
-        if keyin == curses.KEY_UP and hist_counter < len(hist_commands):
-            hist_counter += 1
-        elif keyin == curses.KEY_DOWN and hist_counter > 0:
-            hist_counter -= 1
-        return hist_counter, buff
+        Args:
+        keyin   - The key just pressed, up or down
+        buff    - The line currently being edited, kept if there is no
+                  command to move to
+        """
+        if keyin == curses.KEY_UP:
+            command = self.history.older()
+        else:
+            command = self.history.newer()
+        if command is None:
+            return buff
+        return command
 
     def _script_in(self):
         """
         Substitute for _input used when reading from a script.
         Returns the next command from the script being read.
+        Blank lines are skipped. Returns None once the script ends.
         """
-        if not self.script_lines:
-            return None
-
-        if self.script_counter < len(self.script_lines):
-            command = self.script_lines[self.script_counter]
-            self.script_counter += 1
-        else:
-            command = None
-        return command
+        while self.script is not None:
+            try:
+                command = next(self.script)
+            except StopIteration:
+                self.script = None
+            except (IOError, OSError) as e:
+                self.script_error = e
+                self.put("Error reading script '%s': %s" % (self.script.name, e.strerror or e))
+                self.script.close()
+                self.script = None
+            else:
+                if command.strip():
+                    return command
+        return None
 
     def main_loop(self):
         """
@@ -483,57 +1322,327 @@ class Shell():
             run command
 
         This loop can be broken out of only with by a command returning
-        constants.CHOICE_QUIT or by pressing F1
+        constants.CHOICE_QUIT, by pressing F1, or by the renderer running
+        out of input
         """
+        self._ui_thread = threading.current_thread()
         ret_choice = None
         while ret_choice != constants.CHOICE_QUIT:
-            success = True
-            ret_choice = constants.CHOICE_INVALID
             choice = self._script_in()
             if choice:
                 self.put("%s%s" % (self.prompt, choice))
             else:
-                choice = self._input(self.prompt)
-            tokens = choice.split()
-            if len(tokens) == 0:
-                self.put("\n")
-                continue
-            command = self._get_command(choice)
-            if not command:
-                self.put("Invalid command - no match")
-                continue
-            try:
-                args, kwargs = command.parse_command(tokens)
-                success, message = command.validate(*args, **kwargs)
-                if not success:
-                    self.put(message)
-                else:
-                    ret_choice = command.run(*args, **kwargs)
-                    if ret_choice == constants.CHOICE_INVALID:
-                        self.put("Invalid command")
-                    else:
-                        menus = [a.name for a in self.menus]
-                        if str(ret_choice).lower() in menus:
-                            self.menu = ret_choice.lower()
-                        else:
-                            self.put("New menu '%s' not found" % ret_choice.lower())
-            except Exception as e:
-                self.put(e)
+                try:
+                    choice = self._input(self.prompt)
+                except EOFError:
+                    break
+            ret_choice = self._dispatch(choice)
+            self._drain_ui_queue()
+        self._flush_frame()
         return self
 
+    def main_loop_async(self):
+        """
+        Return a coroutine running the main shell IO loop on an asyncio
+        event loop. Requires Python 3.7 or newer.
+
+        This works like main_loop(), except that keys are read from stdin by
+        the event loop, and a command's run, validate and tabcomplete hook
+        callbacks may be coroutine functions (async def). While a command
+        awaits, the screen keeps updating and the user can keep typing and
+        start other commands.
+
+        if __name__ == "__main__":
+            asyncio.run(MyShell().main_loop_async()).end()
+        """
+        from candela import aio
+        return aio.main_loop(self)
+
+    def _dispatch(self, choice):
+        """
+        Find, validate and run the command named in a line of input
+
+        Args:
+        choice  - The line of input
+
+        Return:
+        The value returned by the command's run function, or
+        constants.CHOICE_INVALID if the command did not run
+        """
+        parsed = self._parse_choice(choice)
+        if not parsed:
+            return constants.CHOICE_INVALID
+        command, args, kwargs = parsed
+        ret_choice = constants.CHOICE_INVALID
+        try:
+            success, message = command.validate(*args, **kwargs)
+            if not success:
+                self.put(message)
+            else:
+                result = command.run(*args, **kwargs)
+                if self._is_stream(result):
+                    result = self._stream(result)
+                ret_choice = result
+                self._handle_choice(ret_choice)
+        except Exception as e:
+            self.put(e)
+        return ret_choice
+
+    def _is_stream(self, result):
+        """
+        Return True if a run function returned an iterator of output, such
+        as a generator, rather than a result
+        """
+        return hasattr(result, '__next__') or hasattr(result, 'next')
+
+    def _stream(self, output):
+        """
+        Print the strings yielded by a run function as they are produced,
+        and return the run function's result.
+
+        A run function can be a generator, like so:
+
+        def _run(*args, **kwargs):
+            for path in walk(args[0]):
+                yield path
+
+        The screen is redrawn at most stream_refresh_rate times per second, no
+        matter how fast the strings arrive. Pressing interrupt_key stops the
+        stream. Other keys pressed meanwhile go to the next input line.
+
+        On Python 3, the value a generator returns is the command's result,
+        so it can switch menus or quit. Otherwise it is CHOICE_VALID.
+
+        Args:
+        output  - The iterator returned by the run function
+        """
+        interrupts = self._interrupts
+        interval = 1.0 / self.stream_refresh_rate
+        last = time.time()
+        ret_choice = constants.CHOICE_VALID
+        try:
+            while True:
+                try:
+                    chunk = next(output)
+                except StopIteration as e:
+                    if getattr(e, 'value', None) is not None:
+                        ret_choice = e.value
+                    break
+                self._add_output(chunk)
+                now = time.time()
+                if now - last < interval:
+                    continue
+                last = now
+                self._poll_interrupt()
+                if self._interrupts != interrupts:
+                    if hasattr(output, 'close'):
+                        output.close()
+                    self._add_output("Interrupted")
+                    break
+                self._update_screen()
+        finally:
+            self._update_screen()
+        return ret_choice
+
+    def _poll_interrupt(self):
+        """
+        Read the keys pressed while output is streaming without waiting,
+        counting presses of interrupt_key and saving the rest for later
+        """
+        keyin = self.renderer.poll_key()
+        while keyin != -1:
+            if keyin == self.interrupt_key:
+                self._interrupts += 1
+            else:
+                self._typeahead.append(keyin)
+            keyin = self.renderer.poll_key()
+
+    def _parse_choice(self, choice):
+        """
+        Find the command named in a line of input and parse its arguments
+
+        Problems are reported to the user, and None is returned.
+
+        Args:
+        choice  - The line of input
+
+        Return:
+        The tuple of the Command, its positional arguments and its keyword
+        arguments
+        """
+        tokens = choice.split()
+        if len(tokens) == 0:
+            self.put("\n")
+            return None
+        command = self._get_command(choice)
+        if not command:
+            self.put("Invalid command - no match")
+            return None
+        try:
+            args, kwargs = command.parse_command(tokens)
+        except Exception as e:
+            self.put(e)
+            return None
+        return (command, args, kwargs)
+
+    def _handle_choice(self, ret_choice):
+        """
+        React to the value returned by a command's run function, switching
+        to a new menu if it names one
+
+        Args:
+        ret_choice  - The value returned by the command
+        """
+        if ret_choice == constants.CHOICE_INVALID:
+            self.put("Invalid command")
+        elif hasattr(ret_choice, 'lower'):
+            if ret_choice.lower() in self._menu_index:
+                self.menu = ret_choice.lower()
+            else:
+                self.put("New menu '%s' not found" % ret_choice.lower())
+
+    def run_batch(self, script, output=None, echo=False, stop_on_error=False):
+        """
+        Run a script without drawing anything, and return an exit code.
+
+        Commands are found, validated and run exactly as in main_loop(), but
+        the screen is never redrawn. Everything passed to put() is written to
+        output instead, in large buffered writes. Pair this with a
+        NullRenderer to leave the terminal alone, like so:
+
+        if __name__ == "__main__":
+            sys.exit(MyShell(renderer=NullRenderer()).run_batch(sys.argv[1]))
+
+        The script ends early if a command returns constants.CHOICE_QUIT.
+
+        Args:
+        script          - The name of the script file, or '-' for stdin
+
+        Kwargs:
+        output          - The file object or file name to write output to.
+                          Defaults to stdout
+        echo            - Whether to write each command, after the prompt,
+                          before its output
+        stop_on_error   - Whether to stop at the first command that fails
+
+        Return:
+        0 if every command succeeded, otherwise constants.FAILURE. A command
+        fails if it can't be found, parsed or validated, if it raises, or if
+        it returns constants.CHOICE_INVALID
+        """
+        self._ui_thread = threading.current_thread()
+        close = False
+        if output is None:
+            output = sys.stdout
+        elif not hasattr(output, 'write'):
+            output = open(output, 'w')
+            close = True
+        self._output = output
+        failed = False
+        try:
+            self.runscript(script)
+            while True:
+                choice = self._script_in()
+                if choice is None:
+                    break
+                if echo:
+                    self.put("%s%s" % (self.prompt, choice))
+                ret_choice = self._dispatch(choice)
+                self._drain_ui_queue()
+                if ret_choice == constants.CHOICE_QUIT:
+                    break
+                if ret_choice == constants.CHOICE_INVALID:
+                    failed = True
+                    if stop_on_error:
+                        break
+            if self.script_error is not None:
+                failed = True
+        finally:
+            self._flush_output()
+            self._output = None
+            if close:
+                output.close()
+        return constants.FAILURE if failed else 0
+
+    def _write_output(self, output):
+        """
+        Queue a put() for the batch mode output stream
+        """
+        self._output_lines.append(str(output))
+        if len(self._output_lines) >= 1024:
+            self._flush_output()
+
+    def _flush_output(self):
+        """
+        Write the queued batch mode output in one call
+        """
+        if self._output_lines:
+            self._output_lines.append("")
+            self._output.write("\n".join(self._output_lines))
+            self._output_lines = []
+
     def get_menu(self):
         """
         Get the current menu as a Menu
         """
-        if not self.menus: return
-        try:
-            return [a for a in self.menus if a.name == self.menu][0]
-        except:
-            return
+        return self._menu_index.get(getattr(self, 'menu', None))
+
+    def submit(self, func, args=(), kwargs={}, name=None, callback=None,
+               timeout=None, default=None, sticker=True):
+        """
+        Run func on the shell's thread pool without blocking input, and return
+        the Job tracking it.
+
+        While the job runs, a sticker shows its id, status and progress. The
+        job function can report progress and check for cancellation through
+        candela.jobs.current_job(). Failures and cancellations are reported in
+        the shell. The callback is called on the UI thread, where it is safe to
+        call put() and sticker(), like so:
+
+        def _run(*args, **kwargs):
+            def _done(job):
+                self.put("Found %d files" % len(job.result()))
+            self.submit(scan_files, args=(path,), name="scan", callback=_done)
+            return constants.CHOICE_VALID
+
+        Args:
+        func        - The function to run
+
+        Kwargs:
+        args        - The arguments to pass to func
+        kwargs      - The keyword arguments to pass to func
+        name        - The name shown for the job. Defaults to func's name
+        callback    - Called on the UI thread with the job once it is done
+        timeout     - The number of seconds after which the job counts as
+                      cancelled
+        default     - The result of the job if it is cancelled
+        sticker     - Whether to show the job's status in a sticker
+
+        Return:
+        The Job
+        """
+        job = self.jobs.submit(func, args, kwargs, name=name, timeout=timeout,
+                               default=default, callback=callback)
+        if sticker:
+            self._job_stickers[job.id] = None
+        return job
+
+    def cancel(self, id):
+        """
+        Ask the job with the given id to stop
+
+        Args:
+        id      - The id of the job
+
+        Return:
+        False if no such job is running
+        """
+        job = self.jobs.get(id)
+        return job is not None and job.cancel()
 
     def defer(self, func, args=(), kwargs={}, timeout_duration=10, default=None):
         """
-        Create a new thread, run func in the thread for a max of
+        Run func on the shell's thread pool, without blocking, for a max of
         timeout_duration seconds
         This is useful for blocking operations that must be performed
         after the next window refresh.
@@ -561,35 +1670,123 @@ class Shell():
                 self.remove_sticker("Hello!")
             self.defer(clear_sticker)
 
+        Unlike submit(), no sticker is shown for the job, but an exception
+        raised by func is still reported in the shell.
+
         Args:
         func        - The callback function to run in the new thread
 
         Kwargs:
         args        - The arguments to pass to the threaded function
         kwargs      - The keyword arguments to pass to the threaded function
-        timeout_duration - the amount of time in seconds to wait before
-                           killing the thread
-        default     - The value to return in case of a timeout
-        """
-        class InterruptableThread(threading.Thread):
-            def __init__(self):
-                threading.Thread.__init__(self)
-                self.result = default
-            def run(self):
-                self.result = func(*args, **kwargs)
-        it = InterruptableThread()
-        it.start()
-        it.join(timeout_duration)
-        if it.isAlive():
-            return it.result
-        else:
-            return it.result
+        timeout_duration - the amount of time in seconds after which the
+                           job counts as cancelled
+        default     - The result of the job in case of a timeout
+
+        Return:
+        The Job
+        """
+        return self.submit(func, args, kwargs, timeout=timeout_duration,
+                           default=default, sticker=False)
+
+    def call_soon(self, func, *args):
+        """
+        Call func(*args) on the UI thread as soon as it is idle.
+        Safe to call from any thread.
+
+        While main_loop() waits for a key, it checks the queue every
+        poll_interval seconds as long as jobs are running or another thread
+        queued a call in the last threaded_output_window seconds. Calls
+        queued after a longer quiet spell are made with the next key.
+
+        Args:
+        func    - The function to call
+        """
+        # deque.append() and popleft() are atomic, so producers never wait
+        # on a lock
+        self._ui_queue.append((func, args))
+        if not self._on_ui_thread():
+            self._threaded_output_at = time.time()
+        if self._ui_wakeup is not None:
+            self._ui_wakeup()
+
+    def _threaded_output_recent(self):
+        """
+        Return True if another thread has queued a call in the last
+        threaded_output_window seconds
+        """
+        at = self._threaded_output_at
+        return at is not None and time.time() - at < self.threaded_output_window
+
+    def _on_ui_thread(self):
+        """
+        Return True if the calling thread may touch the screen directly
+        """
+        return threading.current_thread() is self._ui_thread
+
+    def _drain_ui_queue(self):
+        """
+        Call the functions queued by call_soon(), redrawing the screen once
+
+        Only the calls queued before this started are made, so that threads
+        that keep queueing can't starve the input line.
+        """
+        if not self._ui_queue:
+            return
+        with self.batch():
+            for i in range(len(self._ui_queue)):
+                func, args = self._ui_queue.popleft()
+                try:
+                    func(*args)
+                except Exception as e:
+                    self.put(e)
+
+    def _job_changed(self, job):
+        """
+        Called from any thread when a job's status or progress changes
+        """
+        if job.id in self._job_stickers:
+            self.call_soon(self._show_job, job)
+        elif job.status == FAILED:
+            # jobs without a sticker still report their errors
+            self.call_soon(self._report_job, job)
+
+    def _show_job(self, job):
+        """
+        Bring the sticker showing a job's status up to date
+        """
+        if job.id not in self._job_stickers:
+            return
+        old = self._job_stickers[job.id]
+        if job.done():
+            del self._job_stickers[job.id]
+            self.remove_sticker(id=('job', job.id))
+            if job.status == CANCELLED:
+                self.put(job.describe())
+            self._report_job(job)
+            return
+        text = job.describe()
+        if text != old:
+            self._job_stickers[job.id] = text
+            self.sticker(text, id=('job', job.id))
+
+    def _report_job(self, job):
+        """
+        Print the error of a job that failed
+        """
+        if job.status == FAILED:
+            self.put("%s (%s)" % (job.describe(), job.error))
+        self._update_screen()
 
     def end(self):
         """
-        End the current Candela shell and safely shut down the curses session
+        End the current Candela shell and safely shut down the renderer
+
+        Running jobs are cancelled.
         """
-        curses.endwin()
+        self.jobs.cancel_all()
+        self.history.close()
+        self.renderer.end()
 
     def _register_sigint_handler(self):
         """
@@ -604,9 +1801,102 @@ class Shell():
     def _update_screen(self):
         """
         Refresh the screen and redraw all elements in their appropriate positions
+
+        The window is never cleared. Instead, every element is composed into an
+        off-screen canvas, which is then compared against the previous frame so
+        that only the damaged cells are written to the terminal.
+
+        Inside a batch() block this only records that an update is due. If
+        max_fps is set and a frame was drawn too recently, it only marks the
+        screen dirty, and the frame is drawn once enough time has passed or
+        the shell is waiting for input.
         """
-        self.height,self.width = self.stdscr.getmaxyx()
-        self.stdscr.clear()
+        if self._batch_depth:
+            self._batch_pending = True
+            return
+        if self._output is not None:
+            return
+        if self._resize_at is not None:
+            self.frames_coalesced += 1
+            self._dirty = True
+            return
+        if self.max_fps:
+            wait = self._last_frame + 1.0 / self.max_fps - time.time()
+            if wait > 0:
+                self.frames_coalesced += 1
+                self._dirty = True
+                if self._render_wakeup is not None:
+                    self._render_wakeup(wait)
+                return
+        self._render()
+
+    def _render_if_due(self):
+        """
+        Draw the frame held back by max_fps or by a resize, or the sticker
+        changes held back by sticker_rate, if they may be drawn now
+
+        Return:
+        The number of seconds until it may be drawn, or None if there is
+        nothing left to draw
+        """
+        if self._resize_at is not None:
+            wait = self._resize_at - time.time()
+            if wait > 0:
+                return wait
+            self._relayout()
+            return None
+        if self._dirty:
+            if self.max_fps:
+                wait = self._last_frame + 1.0 / self.max_fps - time.time()
+                if wait > 0:
+                    return wait
+            self._render()
+        elif self._sticker_damage:
+            if self.sticker_rate:
+                wait = self._last_sticker_paint + 1.0 / self.sticker_rate - time.time()
+                if wait > 0:
+                    return wait
+            self._paint_stickers()
+        return None
+
+    def _flush_frame(self):
+        """
+        Draw any frame or sticker changes held back right away
+        """
+        if self._resize_at is not None:
+            self._relayout()
+        elif self._dirty:
+            self._render()
+        elif self._sticker_damage:
+            self._paint_stickers()
+
+    def _relayout(self):
+        """
+        Read the window size again after a resize, and redraw everything.
+        The backbuffer is wrapped for the new width as it is drawn
+        """
+        self._resize_at = None
+        self.height,self.width = self.renderer.getmaxyx()
+        # after a resize nothing on the terminal can be trusted
+        self._frame = []
+        self.renderer.clear()
+        self._render()
+
+    def _render(self):
+        """
+        Compose the whole window and write the damaged cells to the terminal
+        """
+        self._dirty = False
+        self._sticker_damage.clear()
+        self._last_frame = time.time()
+        self.frames_rendered += 1
+
+        if not self._frame:
+            self.renderer.erase()
+
+        # the last column is left alone, since writing to the bottom right
+        # cell of the window makes curses raise an error
+        self._canvas = [" "*(self.width-1)]*self.height
 
         self._print_backbuffer()
 
@@ -616,13 +1906,77 @@ class Shell():
             self._print_header()
             if self.should_show_help:
                 self._print_help()
+        self._base = list(self._canvas)
         self._print_stickers()
+        self._print_inputline()
+
+        self._flush_canvas()
+
+    def _print_inputline(self):
+        """
+        Print the current contents of the input line on the bottom row
+        """
+        self._draw(self.height-1, 0, self._inputline)
 
-        self.stdscr.refresh()
+    def _draw(self, ypos, xpos, text):
+        """
+        Write text into the canvas for the next frame, clipped to the window
+
+        Args:
+        ypos    - The row to write to
+        xpos    - The column of the first character of text
+        text    - The string to write. Must not contain newlines
+        """
+        if ypos < 0 or ypos >= len(self._canvas):
+            return
+        row = self._canvas[ypos]
+        if xpos >= len(row):
+            return
+        if xpos < 0:
+            text = text[-xpos:]
+            xpos = 0
+        text = text.expandtabs()[:len(row)-xpos]
+        if not text:
+            return
+        self._canvas[ypos] = row[:xpos] + text + row[xpos+len(text):]
+
+    def _flush_canvas(self, rows=None):
+        """
+        Write the damaged parts of the canvas to the terminal
+
+        Each canvas row is compared against the row in the previous frame.
+        Unchanged rows are skipped, and for changed rows only the span between
+        the first and last differing cells is written. All writes are batched
+        into a single terminal update.
+
+        Kwargs:
+        rows    - The list of row indices to consider. Defaults to every row
+        """
+        if rows is None:
+            rows = range(len(self._canvas))
+        if len(self._frame) != len(self._canvas):
+            self._frame = [None]*len(self._canvas)
+        cursor = self.renderer.getyx()
+
+        for ypos in rows:
+            new = self._canvas[ypos]
+            old = self._frame[ypos]
+            if new == old:
+                continue
+            lo, hi = 0, len(new)
+            if old is not None and len(old) == hi:
+                while new[lo] == old[lo]:
+                    lo += 1
+                while new[hi-1] == old[hi-1]:
+                    hi -= 1
+            self.renderer.addstr(ypos, lo, new[lo:hi])
+            self._frame[ypos] = new
+
+        self.renderer.move(*cursor)
+        self.renderer.refresh()
 
     def _get_platform(self):
         """
-        Return the platform name. This is fine, but it's used in a hacky way to
-        get around a backspace-cooking behavior in Linux (at least Ubuntu)
+        Return the platform name
         """
         return platform.uname()[0]
@@ -15,16 +15,18 @@ You should have received a copy of the GNU General Public License
 along with Candela.  If not, see <http://www.gnu.org/licenses/>.
 """
 import getpass
+import sys
 
-from candela.shell import Shell
+from candela.shell import Shell, NullRenderer
+from candela.parallel import run_scripts, format_report
 from candela.menu import Menu
 from candela.command import Command, QuitCommand, RunScriptCommand, BackCommand, ClearCommand
 from candela import constants
 
 
 class MyShell(Shell):
-    def __init__(self):
-        Shell.__init__(self)
+    def __init__(self, renderer=None):
+        Shell.__init__(self, renderer=renderer)
 
         self.name = "My Shell"
 
@@ -264,4 +266,12 @@ Try running\nrun script_example.txt
 
 
 if __name__ == "__main__":
+    # python shell_example.py --batch script_example.txt runs the script
+    # without taking over the terminal. several scripts run in parallel
+    if len(sys.argv) == 3 and sys.argv[1] == '--batch':
+        sys.exit(MyShell(renderer=NullRenderer()).run_batch(sys.argv[2], echo=True))
+    if len(sys.argv) > 3 and sys.argv[1] == '--batch':
+        results = run_scripts(MyShell, sys.argv[2:], echo=True)
+        print(format_report(results))
+        sys.exit(max(r.exit_code for r in results))
     MyShell().main_loop().end()